@@ -3,23 +3,91 @@
 import argparse
 import json
 import sys
+import os
+import time
+import fcntl
+import hashlib
+import tempfile
 import requests
 import math
 
 class Startup(object):
  
-    def __init__(self, hostname, user, secret):
+    def __init__(self, hostname, user, secret, cache_ttl=0, cache_dir=None):
         self._hostname = hostname
         self._user = user
         self._secret = secret
  
         self._ep = 'http://%s/api/v1.0' % hostname
+
+        #one keep-alive connection for every request this run
+        self._session = requests.Session()
+        self._responses = {}
+
+        self._cache_ttl = cache_ttl
+        self._cache_dir = cache_dir if cache_dir is not None else tempfile.gettempdir()
+
+        #check_all collects the output of each check here so the summary can be printed first
+        self._lines = None
+
+    def _output(self, line):
+        if self._lines is None:
+            print line
+        else:
+            self._lines.append(line)
  
     def request(self, resource, method='GET', data=None):
+        if method != 'GET':
+            return self._request(resource, method, data)
+
+        #only ask for each resource once per run
+        if resource not in self._responses:
+            if self._cache_ttl > 0:
+                self._responses[resource] = self._cached_request(resource)
+            else:
+                self._responses[resource] = self._request(resource)
+
+        return self._responses[resource]
+
+    def _cached_request(self, resource):
+        #responses are shared between processes, keyed by host and resource
+        key = hashlib.md5(('%s/%s' % (self._hostname, resource.strip('/'))).encode('utf-8')).hexdigest()
+        path = os.path.join(self._cache_dir, 'check_freenas_%s.json' % key)
+
+        #hold the lock while fetching so other checks wait for this response instead of asking again
+        lock_file = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            try:
+                if time.time() - os.path.getmtime(path) < self._cache_ttl:
+                    with open(path, 'r') as f:
+                        return json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+
+            result = self._request(resource)
+
+            if result is not None:
+                #mkstemp picks an unused name, a file or link someone else made in the shared temp dir isn't written through
+                fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+                try:
+                    with os.fdopen(fd, 'w') as f:
+                        json.dump(result, f)
+                    os.rename(tmp_path, path)
+                except:
+                    os.remove(tmp_path)
+                    raise
+
+            return result
+        finally:
+            lock_file.close()
+
+    def _request(self, resource, method='GET', data=None):
         if data is None:
             data = ''
         try:
-            r = requests.request(
+            r = self._session.request(
                 method,
                 '%s/%s/' % (self._ep, resource),
                 data=json.dumps(data),
@@ -49,11 +117,11 @@ class Startup(object):
             sys.exit(3)
  
         if errors > 0:
-            print 'WARNING - There are ' + str(errors) + ' replication errors. Go to Storage > Replication Tasks > View Replication Tasks in FreeNAS for more details.'
-            sys.exit(1)
+            self._output('WARNING - There are ' + str(errors) + ' replication errors. Go to Storage > Replication Tasks > View Replication Tasks in FreeNAS for more details.')
+            return 1
         else:
-            print 'OK - No replication errors'
-            sys.exit(0)
+            self._output('OK - No replication errors')
+            return 0
  
     def check_alerts(self):
         alerts = self.request('system/alert')
@@ -67,11 +135,11 @@ class Startup(object):
             sys.exit(3)
  
         if errors > 0:
-            print 'WARNING - There are ' + str(errors) + ' alerts. Click Alert button in FreeNAS for more details.'
-            sys.exit(1)
+            self._output('WARNING - There are ' + str(errors) + ' alerts. Click Alert button in FreeNAS for more details.')
+            return 1
         else:
-            print 'OK - No problem alerts'
-            sys.exit(0)
+            self._output('OK - No problem alerts')
+            return 0
 
     def check_volume_size(self,warn,crit):
         volumes = self.request('storage/volume/')
@@ -79,7 +147,7 @@ class Startup(object):
         
         try:
             for volume in volumes:
-                print 'Volume ' + volume['name'] + ' has ' + volume['used_pct'] + ' used of ' + str(self.convertBytes(volume['avail'],'GB')) + 'GB'
+                self._output('Volume ' + volume['name'] + ' has ' + volume['used_pct'] + ' used of ' + str(self.convertBytes(volume['avail'],'GB')) + 'GB')
                 percentUsed = int(volume['used_pct'][:-1])
 
                 if(percentUsed >= warn and exit_code <= 1):
@@ -91,7 +159,7 @@ class Startup(object):
             print 'UNKNOWN - Error when contacting the freenas server: ' + str(sys.exc_info())
             sys.exit(3)
 
-        sys.exit(exit_code)
+        return exit_code
 
     def check_volume_status(self):
         volumes = self.request('storage/volume/')
@@ -99,7 +167,7 @@ class Startup(object):
 
         try:
             for volume in volumes:
-                print 'Volume ' + volume['name'] + ' is ' + volume['status']
+                self._output('Volume ' + volume['name'] + ' is ' + volume['status'])
 
                 if(volume['status'] != 'HEALTHY'):
                     exit_code = 2
@@ -108,7 +176,7 @@ class Startup(object):
             print 'UNKNOWN - Error when contacting the freenas server: ' + str(sys.exc_info())
             sys.exit(3)
 
-        sys.exit(exit_code)
+        return exit_code
 
     def convertBytes(self,byteSize,convertTo):
         result = byteSize
@@ -123,28 +191,56 @@ class Startup(object):
             result = byteSize/math.pow(2,40)
 
         return '{0:.3f}'.format(result)
+
+    def check_all(self,warn,crit):
+        #every check against the same responses, the first line is the worst status and the details follow
+        #an UNKNOWN from a check still exits straight away, so it is the first line too
+        self._lines = []
+        results = [('alerts', self.check_alerts()), ('replication', self.check_repl()), ('volume status', self.check_volume_status())]
+
+        #volume size needs thresholds
+        if warn is not None and crit is not None:
+            results.append(('volume size', self.check_volume_size(warn,crit)))
+
+        lines = self._lines
+        self._lines = None
+
+        exit_code = max([code for name, code in results])
+        if exit_code == 0:
+            print 'OK - All ' + str(len(results)) + ' checks passed'
+        else:
+            print ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN'][exit_code] + ' - Problems with ' + ', '.join([name for name, code in results if code > 0])
+
+        for line in lines:
+            print line
+
+        return exit_code
  
 def main():
     parser = argparse.ArgumentParser(description='Checks a freenas server using the API')
     parser.add_argument('-H', '--hostname', required=True, type=str, help='Hostname or IP address')
     parser.add_argument('-u', '--user', required=True, type=str, help='Normally only root works')
     parser.add_argument('-p', '--passwd', required=True, type=str, help='Password')
-    parser.add_argument('-t', '--type', required=True, type=str, help='Type of check (alerts,repl,vol_size,vol_status)')
+    parser.add_argument('-t', '--type', required=True, type=str, help='Type of check (alerts,repl,vol_size,vol_status,all)')
     parser.add_argument('-c', '--crit',required=False,type=int,help='Critical percent to check (volume check only')
     parser.add_argument('-w', '--warn',required=False,type=int,help='Warning percent to check (volume check only')
+    parser.add_argument('-T', '--cache_ttl',required=False,type=int,default=0,help='Seconds to share API responses between checks, default 0 (off)')
+    parser.add_argument('-d', '--cache_dir',required=False,type=str,help='Directory for shared API responses, default is the temp directory')
 
     args = parser.parse_args(sys.argv[1:])
  
-    startup = Startup(args.hostname, args.user, args.passwd)
+    startup = Startup(args.hostname, args.user, args.passwd, args.cache_ttl, args.cache_dir)
  
     if args.type == 'alerts':
-        startup.check_alerts()
+        sys.exit(startup.check_alerts())
     elif args.type == 'repl':
-        startup.check_repl()
+        sys.exit(startup.check_repl())
     elif args.type == 'vol_size':
-        startup.check_volume_size(args.warn,args.crit)
+        sys.exit(startup.check_volume_size(args.warn,args.crit))
     elif args.type == 'vol_status':
-        startup.check_volume_status()
+        sys.exit(startup.check_volume_status())
+    elif args.type == 'all':
+        sys.exit(startup.check_all(args.warn,args.crit))
     else:
         print "Unknown type: " + args.type
         sys.exit(3)
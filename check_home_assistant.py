@@ -1,25 +1,34 @@
 #!/usr/bin/env python3
-"""Can check the state of a Home Assistant entity. Use -h for arg descriptions"""
+"""Can check the state of a Home Assistant entity, or a list of entities from a rules file with one request. Use -h for arg descriptions"""
 import requests
 import json
 import argparse
+import fcntl
+import os
 import sys
+import time
+
+#rule keys that are numeric thresholds
+THRESHOLD_KEYS = ['critical_above', 'critical_below', 'warning_above', 'warning_below']
 
 class HomeAssistant:
     url = None
     token = None
 
-    def __init__(self, url, token):
+    def __init__(self, url, token, timeout=30):
         self.url = url
         self.token = token
+        self.timeout = timeout
 
-    def _makeRequest(self, endpoint):
-        headers = {
+        #one keep-alive connection for every request
+        self.session = requests.Session()
+        self.session.headers.update({
             'Authorization': 'Bearer %s' % self.token,
             'content-type': 'application/json',
-        }
+        })
 
-        response = requests.get('%s%s' % (self.url,endpoint), headers=headers)
+    def _makeRequest(self, endpoint):
+        response = self.session.get('%s%s' % (self.url,endpoint), timeout=self.timeout)
 
         return json.loads(response.text)
 
@@ -29,32 +38,155 @@ class HomeAssistant:
     def getState(self, entity = ''):
         return self.getStates(entity)
 
+    def getAllStates(self):
+        #every entity in one request, as a dict by entity id
+        return {aState['entity_id']: aState for aState in self._makeRequest('/api/states')}
+
+def loadAllStates(h, cacheFile, ttl):
+    #hold the lock while fetching so other checks wait for this snapshot
+    lockFile = open(cacheFile + '.lock', 'a')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+        try:
+            if(time.time() - os.path.getmtime(cacheFile) < ttl):
+                with open(cacheFile, 'r') as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        states = h.getAllStates()
+
+        tmpFile = '%s.%d' % (cacheFile, os.getpid())
+        fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(states, f)
+        os.replace(tmpFile, cacheFile)
+
+        return states
+    finally:
+        lockFile.close()
+
+def checkEntity(aState, critical='off', attribute=None, rule=None):
+    #returns the exit code and output for an entity's state
+    rule = {} if rule is None else rule
+
+    #display attribute, if set
+    if(attribute is not None):
+        value = aState['attributes'].get(attribute)
+        output = '%s' % value
+    else:
+        value = aState['state']
+        output = '%s: %s' % (aState['attributes'].get('friendly_name', aState['entity_id']), aState['state'])
+
+    #figure out the exit condition
+    exitCode = 0
+    if(aState['state'] == critical):
+        exitCode = 2
+
+    #numeric thresholds are checked against the attribute if there is one, otherwise the state
+    thresholds = [(2, 'critical_above', lambda v, t: v > t), (2, 'critical_below', lambda v, t: v < t),
+                  (1, 'warning_above', lambda v, t: v > t), (1, 'warning_below', lambda v, t: v < t)]
+    if(any(key in rule for code, key, test in thresholds)):
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return (3, '%s is not a number' % output)
+
+        for code, key, test in thresholds:
+            if(key in rule and test(number, float(rule[key]))):
+                exitCode = max(exitCode, code)
+
+    return (exitCode, output)
+
+def checkRules(states, rules):
+    #one (rule, exit code, output) for each rule
+    results = []
+    for rule in rules:
+        aState = states.get(rule['entity'])
+
+        if(aState is None):
+            results.append((rule, 3, '%s not found' % rule['entity']))
+        else:
+            exitCode, output = checkEntity(aState, rule.get('critical', 'off'), rule.get('attribute'), rule)
+            results.append((rule, exitCode, output))
+
+    return results
 
 def main():
 
     parser = argparse.ArgumentParser(description="Checks the status of a Home Assistant entity")
     parser.add_argument('-u', '--url', required=True,type=str, help='Home Assistant URL')
     parser.add_argument('-T', '--token', required=True, type=str, help='The long-lived access token for Home Assistant')
-    parser.add_argument('-E', '--entity', required=True, type=str, help='The entity to check the status of')
+    parser.add_argument('-E', '--entity', required=False, type=str, help='The entity to check the status of')
     parser.add_argument('-c', '--critical', required=False, type=str, default='off', help='The critical state of the sensor, assumes "off" for a binary_sensor')
     parser.add_argument('-a', '--attribute', required=False, type=str, help='Attribute to display instead of the state')
+    parser.add_argument('-r', '--rules', required=False, type=str,
+                        help='JSON file with a list of rules to check from one request, each has an entity and optionally critical, attribute, warning_above, warning_below, critical_above, critical_below and service')
+    parser.add_argument('-C', '--cache', required=False, type=str, help='File to share the states of every entity between checks')
+    parser.add_argument('--ttl', required=False, type=int, default=30, help='Seconds to use the cached states for, default 30')
+    parser.add_argument('-o', '--output', required=False, type=str, choices=['lines','passive'], default='lines', help='Rules output, one line per entity or passive check results')
+    parser.add_argument('--command-file', required=False, type=str, default='/var/run/icinga2/cmd/icinga2.cmd', help='External command file for passive results')
+    parser.add_argument('--passive-host', required=False, type=str, default='homeassistant', help='Host the passive results are for, default homeassistant')
     args = parser.parse_args(sys.argv[1:])
 
+    if(args.entity is None and args.rules is None):
+        parser.error('--entity or --rules is required')
+
     h = HomeAssistant(args.url,args.token)
 
-    aState = h.getState(args.entity)
+    if(args.rules is not None):
+        try:
+            with open(args.rules, 'r') as f:
+                rules = json.load(f)
+        except (OSError, ValueError) as e:
+            print('Error reading %s: %s' % (args.rules, e))
+            sys.exit(3)
 
-    #display attribute, if set
-    if(args.attribute is not None):
-        print('%s' % aState['attributes'][args.attribute])
-    else:
-        print('%s: %s' % (aState['attributes']['friendly_name'], aState['state']))
+        if(not isinstance(rules, list) or not all(isinstance(rule, dict) and 'entity' in rule for rule in rules)):
+            print('%s must be a list of rules that each have an entity' % args.rules)
+            sys.exit(3)
 
-    #figure out the exit condition
-    if(aState['state'] == args.critical):
-        exit(2)
+        #a threshold that isn't a number would only fail once that entity is checked
+        for rule in rules:
+            for key in [aKey for aKey in THRESHOLD_KEYS if aKey in rule]:
+                try:
+                    float(rule[key])
+                except (TypeError, ValueError):
+                    print('%s in the rule for %s must be a number, not %s' % (key, rule['entity'], rule[key]))
+                    sys.exit(3)
+
+        #every entity comes from the same snapshot
+        states = loadAllStates(h, args.cache, args.ttl) if args.cache is not None else h.getAllStates()
+        results = checkRules(states, rules)
+
+        if(args.output == 'passive'):
+            now = int(time.time())
+            with open(args.command_file, 'a') as f:
+                for rule, exitCode, output in results:
+                    #a newline in an attribute value would split the external command
+                    f.write('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (now, args.passive_host, rule.get('service', rule['entity']), exitCode, output.replace('\n', ' ')))
+
+            print('Submitted results for %d entities' % len(results))
+            sys.exit(0)
+
+        for rule, exitCode, output in results:
+            print('%s: %s' % (rule.get('service', rule['entity']), output))
+
+        sys.exit(max([exitCode for rule, exitCode, output in results] + [0]))
+
+    if(args.cache is not None):
+        aState = loadAllStates(h, args.cache, args.ttl).get(args.entity)
+        if(aState is None):
+            print('%s not found' % args.entity)
+            exit(3)
     else:
-        exit(0)
+        aState = h.getState(args.entity)
+
+    exitCode, output = checkEntity(aState, args.critical, args.attribute)
+    print(output)
+
+    exit(exitCode)
 
 if __name__ == '__main__':
     main()
@@ -3,21 +3,139 @@
 import argparse
 import types
 import sys
-import xml.dom.minidom
+import os
+import json
+import time
+import fcntl
+import tempfile
+import xml.etree.ElementTree as ElementTree
 import requests
 import hashlib
+from io import BytesIO
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 from requests.packages.urllib3.exceptions import InsecureRequestWarning,InsecurePlatformWarning,SNIMissingWarning
 
 #disable insecure request warnings
 requests.packages.urllib3.disable_warnings((InsecureRequestWarning,InsecurePlatformWarning,SNIMissingWarning))
 
+EXIT_CODES = {'OK':0,'Warning':1,'Critical':2}
+
+#commands run for every status check
+STATUS_COMMANDS = ['show/disks','show/vdisks','show/enclosures','show/sensor-status','show/frus']
+
+def parseObjects(source):
+    """parse an MSA response in a single pass, returns a list of (object name, {property name: value})"""
+    result = []
+    stack = []
+
+    for event,elem in ElementTree.iterparse(source,events=('start','end')):
+        if(elem.tag == 'OBJECT'):
+            if(event == 'start'):
+                stack.append((elem.get('name'),{}))
+            else:
+                result.append(stack.pop())
+                elem.clear()
+        elif(elem.tag == 'PROPERTY' and event == 'end'):
+            #the last property with a given name wins
+            if(len(stack) > 0):
+                stack[-1][1][elem.get('name')] = elem.text
+            elem.clear()
+
+    return result
+
+class UnknownError(Exception):
+    """raised when the state of an MSA can't be determined"""
+    pass
+
+class SessionExpiredError(Exception):
+    """raised when the MSA rejects a cached session key"""
+    pass
+
+class SessionCache:
+    """stores MSA session keys on disk so each check doesn't have to log in again"""
+    path = None
+    ttl = 0
+    
+    def __init__(self,path,ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def _lock(self,mode):
+        #lock a separate file so the cache itself can be replaced atomically
+        lockFile = open(self.path + '.lock','a')
+        fcntl.flock(lockFile,mode)
+        return lockFile
+
+    def _read(self):
+        try:
+            with open(self.path,'r') as f:
+                return json.load(f)
+        except (IOError,OSError,ValueError):
+            return {}
+
+    def _write(self,sessions):
+        #write to a new temp file readable only by this user, then swap it in
+        #mkstemp picks an unused name so a file or link someone else made in a shared temp dir isn't written through
+        fd,tmpPath = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            with os.fdopen(fd,'w') as f:
+                json.dump(sessions,f)
+            os.rename(tmpPath,self.path)
+        except:
+            os.remove(tmpPath)
+            raise
+
+    def get(self,key):
+        result = None
+        
+        lockFile = self._lock(fcntl.LOCK_SH)
+        try:
+            entry = self._read().get(key)
+        finally:
+            lockFile.close()
+
+        #only use keys that haven't expired
+        if(entry != None and time.time() - entry['created'] < self.ttl):
+            result = entry['session']
+
+        return result
+
+    def set(self,key,session):
+        lockFile = self._lock(fcntl.LOCK_EX)
+        try:
+            sessions = self._read()
+            now = time.time()
+
+            #drop anything expired while we're here
+            sessions = {k:v for k,v in sessions.items() if now - v['created'] < self.ttl}
+
+            if(session != None):
+                sessions[key] = {'session':session,'created':now}
+            elif(key in sessions):
+                del sessions[key]
+                
+            self._write(sessions)
+        finally:
+            lockFile.close()
+
+    def remove(self,key):
+        self.set(key,None)
+
 class HttpGetter:
     address = None
     secret = None
     session = None
+    cache = None
+    cacheKey = None
+    cachedSession = False
+    http = None
+    timeout = 10
+    deadline = 30
     
-    def __init__(self,host,username,password,secure):
+    def __init__(self,host,username,password,secure,cache=None,timeout=10,deadline=30):
         
         #build the URL
         if(secure):
@@ -29,145 +147,213 @@ class HttpGetter:
         md5 = hashlib.md5()
         md5.update(str(username + "_" + password).encode('utf-8'))
         self.secret = '/api/login/%s' % (md5.hexdigest())
+
+        #session keys are cached per host and user
+        self.cache = cache
+        self.cacheKey = '%s@%s' % (username,host)
+
+        #share one keep-alive connection pool across all commands
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,pool_maxsize=len(STATUS_COMMANDS))
+        self.http.mount('http://',adapter)
+        self.http.mount('https://',adapter)
+
+        self.timeout = timeout
+        self.deadline = deadline
         
+    def _login(self):
+        #try a cached session key before logging in
+        if(self.cache != None):
+            self.session = self.cache.get(self.cacheKey)
+            self.cachedSession = (self.session != None)
+
+        if(self.session == None):
+            self._auth()
+
+            if(self.cache != None and self.session != None):
+                self.cache.set(self.cacheKey,self.session)
+
+    def _sessionExpired(self,r,objects):
+        #the MSA returns an error status object when the session key is no longer valid
+        if(r.status_code in (401,403)):
+            return True
+
+        for objName,props in objects:
+            if(objName == 'status'):
+                if((props.get('response-type') or '').lower() == 'error' and 'session' in (props.get('response') or '').lower()):
+                    return True
+
+        return False
+
     def _auth(self):
         
         #authenticate
         try:
-            r = requests.post(
+            r = self.http.post(
                 self.address,
                 verify=False,
-                data=self.secret
+                data=self.secret,
+                timeout=self.timeout
             )
         except:
-            print('UNKNOWN - Error when contacting MSA: ' + str(sys.exc_info()))
-            sys.exit(3)
+            raise UnknownError('Error when contacting MSA: ' + str(sys.exc_info()))
 
         if(r.ok):
             success = False
             try:
                 #get the text
-                doc = xml.dom.minidom.parseString(r.text)
-                
-                for property in doc.getElementsByTagName('PROPERTY'):
+                for objName,props in parseObjects(BytesIO(r.content)):
                     #if this is the response type
-                    if(property.getAttribute('name') == 'response-type'):
-                        if(property.firstChild.nodeValue == 'success'):
+                    if(objName == 'status'):
+                        if(props['response-type'] == 'success'):
                             success = True
-                        elif(property.firstChild.nodeValue == 'error'):
-                            print('UNKNOWN - Authentication Error')
-                            sys.exit(3)
-                if(success):
-                    #get the session key
-                    prop = doc.getElementsByTagName("PROPERTY")[2]
-                    self.session = prop.firstChild.nodeValue
+                            
+                            #get the session key
+                            self.session = props['response']
+                        elif(props['response-type'] == 'error'):
+                            raise UnknownError('Authentication Error')
                     
+            except UnknownError:
+                raise
             except:
-                print('UNKNOWN - Error when contacting MSA: ' + str(sys.exc_info()))
-                sys.exit(3)
+                raise UnknownError('Error when contacting MSA: ' + str(sys.exc_info()))
 
     def _httpGet(self,command):
         #run command on MSA
-        r = requests.get(
+        r = self.http.get(
             command,
             verify=False,
             cookies = {"wbisessionkey":self.session,'wbiusername':''},
-            data=''
+            data='',
+            timeout=self.timeout,
+            stream=True
         )
 
-        #parse xml
-        return xml.dom.minidom.parseString(r.text)
+        #parse xml as it arrives
+        try:
+            r.raw.decode_content = True
+            objects = parseObjects(r.raw)
+        finally:
+            r.close()
+
+        #a cached key may have been dropped by the controller
+        if(self.cachedSession and self._sessionExpired(r,objects)):
+            raise SessionExpiredError(command)
+
+        return objects
+
+    def _fetchAll(self,commands):
+        result = {}
+
+        #send every command at once, the check takes as long as the slowest one
+        pool = ThreadPool(len(commands))
+        try:
+            pending = {}
+            for command in commands:
+                pending[command] = pool.apply_async(self._httpGet,("%s%s" % (self.address,command),))
+
+            stopTime = time.time() + self.deadline
+            for command in commands:
+                result[command] = pending[command].get(max(0,stopTime - time.time()))
+        except SessionExpiredError:
+            #log in again and retry once
+            pool.terminate()
+            self.cache.remove(self.cacheKey)
+            self.session = None
+            self.cachedSession = False
+            self._login()
+
+            return self._fetchAll(commands)
+        except TimeoutError:
+            raise UnknownError('MSA did not respond within %d seconds' % self.deadline)
+        except:
+            raise UnknownError('Error when contacting MSA: ' + str(sys.exc_info()))
+        finally:
+            pool.terminate()
+
+        return result
                 
-    def _findPropStatus(self,xml,propertyName):
-        result = None
-        for prop in xml:
-            if(prop.getAttribute(propertyName['name']) == propertyName['value']):
-                result = prop.firstChild.nodeValue
+    def _findPropStatus(self,props,propertyName):
+        result = props.get(propertyName)
         
         if(result == None):
-            print('UNKNOWN - Error parsing MSA response')
-            sys.exit(3)
+            raise UnknownError('Error parsing MSA response')
         
         return result
 
-    def _runCommand(self,command,objName,propName,propValue):
+    def _runCommand(self,objects,objName,propName):
         result = []
         
         try:
-            doc = self._httpGet("%s%s" % (self.address,command))
-            
-            for obj in doc.getElementsByTagName('OBJECT'):
+            for aName,props in objects:
                 
-                if(obj.getAttribute('name') == objName):
-                    result.append(self._findPropStatus(obj.getElementsByTagName('PROPERTY'),{'name':propName,'value':propValue}))
+                if(aName == objName):
+                    result.append(self._findPropStatus(props,propName))
             
         except:
-            print('UNKNOWN - Error parsing xml: ' + str(sys.exc_info()))
-            sys.exit(3)
+            raise UnknownError('Error parsing xml: ' + str(sys.exc_info()))
             
         return result
     
-    def _findSensorTypes(self,command):
+    def _findSensorTypes(self,objects):
         result = {}
         allowed = ['Temperature','Voltage','Overall']
         try:
-            doc = self._httpGet("%s%s" % (self.address,command))
-            
-            for obj in doc.getElementsByTagName("OBJECT"):
+            for objName,props in objects:
                 
-                if(obj.getAttribute('name') == 'sensor'):
+                if(objName == 'sensor'):
                     #get the sensor type
-                    typeName = self._findPropStatus(obj.getElementsByTagName("PROPERTY"),{'name':'name','value':'sensor-type'})
+                    typeName = self._findPropStatus(props,'sensor-type')
                     
                     if(typeName in allowed):
                         if(typeName not in result):
                             result[typeName] = []
                     
-                        result[typeName].append(self._findPropStatus(obj.getElementsByTagName("PROPERTY"),{'name':'name','value':'status'}))
+                        result[typeName].append(self._findPropStatus(props,'status'))
             
         except:
-            print('UNKNOWN - Error parsing xml: ' + str(sys.exc_info()))
-            sys.exit(3)
+            raise UnknownError('Error parsing xml: ' + str(sys.exc_info()))
                 
         return result
     
-    def _findFRU(self,command):
+    def _findFRU(self,objects):
         result = {}
         try:
-            doc = self._httpGet("%s%s" % (self.address,command))
-            
-            for obj in doc.getElementsByTagName("OBJECT"):
+            for objName,props in objects:
                 
-                if(obj.getAttribute('name') == 'fru'):
+                if(objName == 'fru'):
                     #get the sensor type
-                    typeName = self._findPropStatus(obj.getElementsByTagName("PROPERTY"),{'name':'name','value':'fru-shortname'})
+                    typeName = self._findPropStatus(props,'fru-shortname')
                     
                     if(typeName not in result):
                         result[typeName] = []
                     
-                    result[typeName].append(self._findPropStatus(obj.getElementsByTagName("PROPERTY"),{'name':'name','value':'fru-status'}))
+                    result[typeName].append(self._findPropStatus(props,'fru-status'))
             
         except:
-            print('UNKNOWN - Error parsing xml: ' + str(sys.exc_info()))
-            sys.exit(3)
+            raise UnknownError('Error parsing xml: ' + str(sys.exc_info()))
                 
         return result
     
-    def getStatus(self):
+    def checkStatus(self):
+        """returns the exit code and status line for this MSA, raises UnknownError if it can't be checked"""
         statuses = {}
         
         #authenticate
         if(self.session == None):
-            self._auth()
+            self._login()
+
+        #run all the commands together
+        responses = self._fetchAll(STATUS_COMMANDS)
 
         #get the disk status
-        statuses['Disk'] = self._runCommand("show/disks",'drive','name','health')
-        statuses['Vdisk'] = self._runCommand("show/vdisks",'virtual-disk','name','health')
-        statuses['Enclosure'] = self._runCommand("show/enclosures",'enclosures','name','health')
+        statuses['Disk'] = self._runCommand(responses["show/disks"],'drive','health')
+        statuses['Vdisk'] = self._runCommand(responses["show/vdisks"],'virtual-disk','health')
+        statuses['Enclosure'] = self._runCommand(responses["show/enclosures"],'enclosures','health')
         
         #get special cases
-        statuses.update(self._findSensorTypes("show/sensor-status"))
-        statuses.update(self._findFRU('show/frus'))
+        statuses.update(self._findSensorTypes(responses["show/sensor-status"]))
+        statuses.update(self._findFRU(responses['show/frus']))
         
         #go through each and record state
         output = ''
@@ -201,27 +387,122 @@ class HttpGetter:
             if(warn == 0 and crit == 0):
                 output = "%s %d OK, " % (output,ok)
             
+        return (EXIT_CODES[overallStatus],output)
+
+    def getStatus(self):
+        try:
+            exitCode,output = self.checkStatus()
+        except UnknownError as e:
+            print('UNKNOWN - %s' % e)
+            sys.exit(3)
+            
         print(output)
         
         #exit with correct error
-        if(overallStatus == 'OK'):
-            sys.exit(0)
-        elif(overallStatus == 'Warning'):
-            sys.exit(1)
-        elif(overallStatus == 'Critical'):
-            sys.exit(2)
+        sys.exit(exitCode)
+
+def readFleet(path,username,password,secure):
+    """read arrays from a file, one per line as: host [username password [secure]] [name=icinga host]"""
+    result = []
+
+    with open(path,'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+
+            if(line != ''):
+                fields = line.split()
+
+                #the Icinga host name for passive results, defaults to the address
+                names = [aField[5:] for aField in fields if aField.startswith('name=')]
+                fields = [aField for aField in fields if not aField.startswith('name=')]
+                
+                if(len(fields) == 1):
+                    fields = fields + [username,password]
+
+                if(len(fields) < 3 or fields[1] == None or fields[2] == None):
+                    raise ValueError('No username or password given for %s' % fields[0])
+
+                arraySecure = secure
+                if(len(fields) > 3):
+                    arraySecure = fields[3].lower() in ('1','true','yes','secure')
+
+                result.append({'host':fields[0],'username':fields[1],'password':fields[2],'secure':arraySecure,'name':names[0] if len(names) > 0 else fields[0]})
+
+    return result
+
+def checkArray(host):
+    """run the status check on one array, errors are returned as an UNKNOWN result"""
+    try:
+        return host.checkStatus()
+    except UnknownError as e:
+        return (3,'UNKNOWN - %s' % e)
+    except:
+        return (3,'UNKNOWN - Error when contacting MSA: ' + str(sys.exc_info()))
+
+def checkFleet(args,cache):
+    hosts = []
+    try:
+        for anArray in readFleet(args.fleet,args.username,args.password,args.secure):
+            hosts.append((anArray['name'],HttpGetter(anArray['host'],anArray['username'],anArray['password'],anArray['secure'],cache,args.timeout,args.deadline)))
+    except (IOError,ValueError) as e:
+        print('UNKNOWN - Error reading %s: %s' % (args.fleet,e))
+        sys.exit(3)
+
+    #poll the arrays together, each one already runs its commands in parallel
+    pool = ThreadPool(max(1,min(args.workers,len(hosts))))
+    try:
+        results = pool.map(checkArray,[host for name,host in hosts])
+    finally:
+        pool.terminate()
+
+    if(args.output == 'passive'):
+        #write external commands so Icinga/Nagios picks each array up as its own passive result
+        now = int(time.time())
+        with open(args.command_file,'a') as f:
+            for (name,host),(exitCode,output) in zip(hosts,results):
+                f.write('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (now,name,args.service,exitCode,output.replace('\n',' ')))
+
+        print('Submitted results for %d arrays' % len(hosts))
+        sys.exit(0)
+    else:
+        worst = 0
+        for (name,host),(exitCode,output) in zip(hosts,results):
+            print('%s: %s' % (name,output))
+            worst = max(worst,exitCode)
+
+        sys.exit(worst)
             
 def main():
 
     parser = argparse.ArgumentParser(description="Checks status of HP MSA devices via web API")
-    parser.add_argument('-H','--host',required=True,type=str,help='IP of the MSA')
-    parser.add_argument('-U','--username',required=True,type=str,help="MSA username")
-    parser.add_argument('-P','--password',required=True,type=str,help="Password to authenticate")
+    parser.add_argument('-H','--host',required=False,type=str,help='IP of the MSA')
+    parser.add_argument('-U','--username',required=False,type=str,help="MSA username")
+    parser.add_argument('-P','--password',required=False,type=str,help="Password to authenticate")
     parser.add_argument('-s','--secure',required=False,type=bool,help="secure connection",default=False)
+    parser.add_argument('-t','--timeout',required=False,type=int,help="seconds to wait on each command",default=10)
+    parser.add_argument('-d','--deadline',required=False,type=int,help="seconds to wait for all commands to finish",default=30)
+    parser.add_argument('--session-cache',required=False,type=str,help="file to cache session keys in",default=os.path.join(tempfile.gettempdir(),'check_hp_msa_sessions.json'))
+    parser.add_argument('--session-ttl',required=False,type=int,help="seconds to reuse a cached session key, 0 disables the cache",default=900)
+    
+    parser.add_argument('-f','--fleet',required=False,type=str,help="file listing arrays to check together, one per line as: host [username password [secure]] [name=icinga host]")
+    parser.add_argument('-W','--workers',required=False,type=int,help="arrays to check at once in fleet mode",default=8)
+    parser.add_argument('-o','--output',required=False,type=str,choices=['lines','passive'],help="fleet mode output, one line per array or passive check results",default='lines')
+    parser.add_argument('--command-file',required=False,type=str,help="external command file for passive results",default='/var/run/icinga2/cmd/icinga2.cmd')
+    parser.add_argument('--service',required=False,type=str,help="service name for passive results",default='MSA Status')
     
     args = parser.parse_args(sys.argv[1:])
 
-    host = HttpGetter(args.host,args.username,args.password,args.secure)
+    if(args.fleet == None and (args.host == None or args.username == None or args.password == None)):
+        parser.error('--host, --username and --password are required unless --fleet is given')
+
+    cache = None
+    if(args.session_ttl > 0):
+        cache = SessionCache(args.session_cache,args.session_ttl)
+
+    if(args.fleet != None):
+        checkFleet(args,cache)
+
+    host = HttpGetter(args.host,args.username,args.password,args.secure,cache,args.timeout,args.deadline)
     host.getStatus()
 
 if __name__ == '__main__':
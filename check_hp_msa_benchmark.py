@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Compare the minidom parsing that check_hp_msa.py used to do with its single pass parser.
+Pass recorded MSA responses (ie: saved output of show/disks) or use --generate to build a synthetic one"""
+import argparse
+import sys
+import timeit
+import tracemalloc
+import xml.dom.minidom
+from io import BytesIO
+from check_hp_msa import parseObjects
+
+def generate_payload(objects,properties):
+    #build a show/disks style response with the given number of drives
+    lines = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>','<RESPONSE VERSION="L100">']
+
+    for i in range(0,objects):
+        lines.append('<OBJECT basetype="drives" name="drive" oid="%d" format="rows">' % (i + 1))
+        for j in range(0,properties):
+            lines.append('<PROPERTY name="prop-%d" type="string" size="32" draw="true" sort="string" display-name="Prop %d">value %d</PROPERTY>' % (j,j,j))
+        lines.append('<PROPERTY name="health" type="string" size="10" draw="true" sort="string" display-name="Health">OK</PROPERTY>')
+        lines.append('</OBJECT>')
+
+    lines.append('<OBJECT basetype="status" name="status" oid="%d">' % (objects + 1))
+    lines.append('<PROPERTY name="response-type" type="string" size="12" draw="false" sort="nosort" display-name="Response Type">Success</PROPERTY>')
+    lines.append('</OBJECT>')
+    lines.append('</RESPONSE>')
+
+    return '\n'.join(lines).encode('utf-8')
+
+def minidom_health(payload,objName):
+    #the old approach, rescan every PROPERTY of the object for each lookup
+    result = []
+    doc = xml.dom.minidom.parseString(payload)
+
+    for obj in doc.getElementsByTagName('OBJECT'):
+        if(obj.getAttribute('name') == objName):
+            value = None
+            for prop in obj.getElementsByTagName('PROPERTY'):
+                if(prop.getAttribute('name') == 'health'):
+                    value = prop.firstChild.nodeValue
+            result.append(value)
+
+    return result
+
+def stream_health(payload,objName):
+    return [props.get('health') for aName,props in parseObjects(BytesIO(payload)) if aName == objName]
+
+def peak_memory(func,payload,objName):
+    tracemalloc.start()
+    func(payload,objName)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MSA response parsing")
+    parser.add_argument('files',nargs='*',help='Recorded MSA XML responses')
+    parser.add_argument('-g','--generate',required=False,type=int,help='Number of drives in a generated show/disks payload')
+    parser.add_argument('-o','--object',required=False,type=str,default='drive',help='Object name to read health from, default drive')
+    parser.add_argument('-n','--number',required=False,type=int,default=20,help='Number of runs per parser, default 20')
+    args = parser.parse_args(sys.argv[1:])
+
+    payloads = []
+    for aFile in args.files:
+        with open(aFile,'rb') as f:
+            payloads.append((aFile,f.read()))
+
+    if(args.generate):
+        payloads.append(('generated %d drives' % args.generate,generate_payload(args.generate,80)))
+
+    if(len(payloads) == 0):
+        parser.error('give at least one recorded response or --generate')
+
+    for name,payload in payloads:
+        #both parsers must agree before timing them
+        if(minidom_health(payload,args.object) != stream_health(payload,args.object)):
+            print('%s: parsers disagree' % name)
+            sys.exit(1)
+
+        print('%s (%d bytes)' % (name,len(payload)))
+        for label,func in (('minidom',minidom_health),('stream',stream_health)):
+            seconds = timeit.timeit(lambda: func(payload,args.object),number=args.number) / args.number
+            print('  %-8s %8.2fms  peak %8.1fKB' % (label,seconds * 1000,peak_memory(func,payload,args.object) / 1024.0))
+
+if __name__ == '__main__':
+    main()
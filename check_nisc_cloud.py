@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """Check the status.cloud.coop site and return an overall status for the services based on embedded html status codes"""
-import argparse, json, sys
+import argparse, fcntl, json, os, sys, time
 
 try:
     import requests
@@ -11,15 +11,20 @@ except ImportError as ie:
 
 __author__ = "Rob Weber"
 __email__ = "rweber@ecec.com"
-__version__ = "1.1"
+__version__ = "1.2"
 
-def getStatus():
+STATUS_URL = 'https://status.cloud.coop'
+
+#exit code for each service status when writing a result per service
+STATUS_CODES = {'normal': 0, 'down': 2}
+
+def getStatus(content):
 
     #full result, convert to json in the end
     result = {}
 
     #parse the html
-    tree = html.fromstring(page.content)
+    tree = html.fromstring(content)
 
     #get rows, skip the header
     rows = tree.xpath('/html/body/div[8]/div/table/tr[position() > 1]')
@@ -28,6 +33,10 @@ def getStatus():
         #get the current status (returns list)
         status = aRow.xpath('td[1]/img')
 
+        #every row under the header is a service, anything else means the layout changed
+        if(len(status) == 0 or ':' not in status[0].get('alt', '')):
+            raise ValueError('row %d has no service:status image' % (rows.index(aRow) + 2))
+
         #split to get service:status pair
         splitString = status[0].get('alt').split(':')
 
@@ -35,29 +44,138 @@ def getStatus():
 
     return result
 
-try:
-    #load the page
-    page = requests.get('https://status.cloud.coop')
-except Error:
-    #if this fails we need to quit here
-    print("status.cloud.coop could not be loaded")
-    sys.exit(3) #unknown
+def parsePage(content):
+    try:
+        services = getStatus(content)
+    except ValueError as e:
+        print('Could not parse status.cloud.coop, the page layout may have changed: %s' % e)
+        sys.exit(3) #unknown
+
+    #no services means the xpath no longer matches, don't report that as everything being normal
+    if(len(services) == 0):
+        print('No services found on status.cloud.coop, the page layout may have changed')
+        sys.exit(3) #unknown
+
+    return services
+
+def fetchPage(timeout, headers=None):
+    try:
+        #load the page
+        page = requests.get(STATUS_URL, headers=headers, timeout=timeout)
+        if(page.status_code != 304):
+            page.raise_for_status()
+    except requests.exceptions.RequestException:
+        #if this fails we need to quit here
+        print("status.cloud.coop could not be loaded")
+        sys.exit(3) #unknown
+
+    return page
+
+def loadServices(args):
+    if(args.cache is None):
+        return parsePage(fetchPage(args.timeout).content)
+
+    #hold the lock while fetching so other checks wait for this download
+    lockFile = open(args.cache + '.lock', 'a')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+
+        cached = None
+        try:
+            with open(args.cache, 'r') as f:
+                cached = json.load(f)
+
+            #within the ttl the parsed services are used as is
+            if(time.time() - os.path.getmtime(args.cache) < args.ttl):
+                return cached['services']
+        except (OSError, ValueError, KeyError):
+            cached = None
+
+        #otherwise ask the site if the page changed since it was cached
+        headers = {}
+        if(cached is not None):
+            if(cached.get('etag')):
+                headers['If-None-Match'] = cached['etag']
+            if(cached.get('modified')):
+                headers['If-Modified-Since'] = cached['modified']
+
+        page = fetchPage(args.timeout, headers)
+
+        if(page.status_code == 304 and cached is not None):
+            #not modified, start the ttl again
+            os.utime(args.cache)
+            return cached['services']
+
+        services = parsePage(page.content)
+
+        tmpFile = '%s.%d' % (args.cache, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'etag': page.headers.get('ETag'), 'modified': page.headers.get('Last-Modified'), 'services': services}, f)
+        os.replace(tmpFile, args.cache)
+
+        return services
+    finally:
+        lockFile.close()
+
+def serviceResults(services, maintenance):
+    #exit code and output for every service
+    codes = dict(STATUS_CODES, maintenance=maintenance)
+
+    results = {}
+    for service,status in services.items():
+        exitCode = codes.get(status, 3)
+        output = '%s is in maintenance' % service if status == 'maintenance' else '%s is %s' % (service, status)
+        results[service] = {'status': status, 'exit_code': exitCode, 'output': output}
+
+    return results
+
+def writeResults(args, services):
+    results = serviceResults(services, 1 if args.maintenance == 'warning' else 0)
+
+    if(args.output == 'passive'):
+        now = int(time.time())
+        with open(args.command_file, 'a') as f:
+            for service,result in sorted(results.items()):
+                f.write('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s%s;%d;%s\n' % (now, args.passive_host, args.service_prefix, service, result['exit_code'], result['output']))
+    else:
+        #the spool is replaced whole so a reader never sees part of it
+        tmpFile = '%s.%d' % (args.spool_file, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'time': int(time.time()), 'services': results}, f)
+        os.replace(tmpFile, args.spool_file)
+
+    print('Wrote results for %d services' % len(results))
 
 #setup the cli parser
 parser = argparse.ArgumentParser(description='check the status.cloud.coop site to see if the services are up, default is to check all services')
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-j','--json',action='store_true',help='print the json formatted results')
 group.add_argument('-s','--service',action='append',help='service to test for normal, can be more than one')
+group.add_argument('-o','--output',choices=['passive','spool'],help='write a result for every service, as passive check results or to a json spool file')
+parser.add_argument('-C','--cache',required=False,help='file to share the parsed status between checks, the site is asked if the page changed once it is older than the ttl')
+parser.add_argument('-T','--ttl',required=False,type=int,default=60,help='seconds to use the cached status without asking the site, default 60')
+parser.add_argument('-t','--timeout',required=False,type=int,default=30,help='seconds to wait for the site, default 30')
+parser.add_argument('-m','--maintenance',required=False,choices=['warning','ok'],default='warning',help='result for a service in maintenance when writing a result for every service, default warning')
+parser.add_argument('--command-file',required=False,default='/var/run/icinga2/cmd/icinga2.cmd',help='external command file for passive results')
+parser.add_argument('--passive-host',required=False,default='status.cloud.coop',help='host the passive results are for, default status.cloud.coop')
+parser.add_argument('--service-prefix',required=False,default='NISC ',help='prefix of the passive result service names, default "NISC "')
+parser.add_argument('--spool-file',required=False,help='json file to write the results to for --output spool')
 
 args = parser.parse_args()
 
-#parse the html
-services = getStatus()
+if(args.output == 'spool' and args.spool_file is None):
+    parser.error('--spool-file is required for --output spool')
+
+#load and parse the html
+services = loadServices(args)
 
 if(args.json):
     #print out everything as json
     print(json.dumps(services))
     sys.exit(0)
+elif(args.output):
+    writeResults(args, services)
+    sys.exit(0)
 else:
     checkServices = [] #services to check
     if(args.service):
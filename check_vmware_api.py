@@ -2,7 +2,11 @@
 import atexit
 import argparse
 import sys
+import os
+import json
 import datetime
+import time
+import tempfile
 import ssl
 #https://github.com/vmware/pyvmomi
 from pyVim import connect
@@ -32,55 +36,283 @@ def get_args():
     parser.add_argument('-U','--user',required=True,type=str,help='Username to connect to vCenter with')
     parser.add_argument('-P','--password',required=True,type=str,help='Password to connect to vCenter with')
     parser.add_argument('-H','--host',required=False,type=str,help='The host to get information about')
-    parser.add_argument('-t','--type',required=True,type=str,help='The type of check (status|datastore|snapshot)')
+    parser.add_argument('-t','--type',required=True,type=str,help='The type of check (status|datastore|snapshot|sweep|perf)')
     parser.add_argument('-w','--warning',required=False,type=int,help='The warning value as a percent')
     parser.add_argument('-c','--critical',required=False,type=int,help='the critical value, as a percent')
+    parser.add_argument('-m','--metric',required=False,action='append',help='Performance counter for the perf check (ie: mem.usage.average), can be more than one')
+    parser.add_argument('--counter-cache',required=False,type=str,help='File to cache performance counter ids in, default is in the temp directory')
+    parser.add_argument('--counter-ttl',required=False,type=int,default=86400,help='Seconds before the counter id cache is refreshed')
+    parser.add_argument('-S','--session-file',required=False,type=str,help='File to save the vCenter session in so later checks can reuse it')
+    parser.add_argument('-o','--output',required=False,type=str,choices=['lines','passive'],default='lines',help='Sweep output, one line per host and datastore or passive check results')
+    parser.add_argument('--command-file',required=False,type=str,default='/var/run/icinga2/cmd/icinga2.cmd',help='External command file for passive results')
+    parser.add_argument('--host-service',required=False,type=str,default='Host Status',help='Service name for host passive results')
+    parser.add_argument('--datastore-host',required=False,type=str,help='Host name for datastore passive results, default is the vCenter service')
+    parser.add_argument('--datastore-service',required=False,type=str,default='Datastore %s',help='Service name for datastore passive results, %%s is the datastore name')
 
     args = parser.parse_args()
 
+    #check the service name template now rather than partway through a sweep
+    try:
+        args.datastore_service % 'datastore'
+    except (TypeError,ValueError):
+        parser.error('--datastore-service needs one %s for the datastore name')
+
     return args
 
-def memory_usage(host,perfManager):
-    metricId = vim.PerformanceManager.MetricId(counterId=6, instance="*")
+def load_session(sessionFile,key):
+    try:
+        with open(sessionFile,'r') as f:
+            return json.load(f).get(key)
+    except (IOError,OSError,ValueError):
+        return None
+
+def save_session(sessionFile,key,cookie):
+    sessions = {}
+    try:
+        with open(sessionFile,'r') as f:
+            sessions = json.load(f)
+    except (IOError,OSError,ValueError):
+        pass
+
+    sessions[key] = cookie
+
+    #the cookie is as good as a password, only this user can read it
+    tmpFile = '%s.%d' % (sessionFile,os.getpid())
+    fd = os.open(tmpFile,os.O_WRONLY | os.O_CREAT | os.O_TRUNC,0o600)
+    with os.fdopen(fd,'w') as f:
+        json.dump(sessions,f)
+    os.rename(tmpFile,sessionFile)
+
+def resume_session(args,cookie):
+    #attach the saved cookie to a new stub, no login needed
+    stub = connect.SmartStubAdapter(host=args.service,port=args.port)
+    stub.cookie = cookie
+    service_instance = vim.ServiceInstance('ServiceInstance',stub)
+
+    try:
+        #currentSession is empty once vCenter has expired the session
+        if(service_instance.content.sessionManager.currentSession != None):
+            return service_instance
+    except (vim.fault.NotAuthenticated,vmodl.fault.SecurityError):
+        pass
+
+    return None
+
+def connect_vcenter(args):
+    service_instance = None
+    sessionKey = '%s@%s:%d' % (args.user,args.service,args.port)
+
+    if(args.session_file != None):
+        cookie = load_session(args.session_file,sessionKey)
+
+        if(cookie != None):
+            service_instance = resume_session(args,cookie)
+
+    if(service_instance == None):
+        service_instance = connect.SmartConnect(host=args.service,user=args.user,pwd=args.password,port=args.port)
+
+        if not service_instance:
+            print "Could not connect to vcenter"
+            sys.exit(-1)
+
+        if(args.session_file != None):
+            #keep the session open for the next check
+            save_session(args.session_file,sessionKey,service_instance._stub.cookie)
+        else:
+            atexit.register(connect.Disconnect,service_instance)
+
+    return service_instance
+
+def collect_properties(content,propSpecs):
+    """retrieve properties for every object of the given types in one property collector call
+    propSpecs maps a type to the property paths wanted, returns a list of dicts with the object under 'obj'"""
+    result = []
+
+    view = content.viewManager.CreateContainerView(content.rootFolder,list(propSpecs.keys()),True)
+
+    #walk the container view and pull only the requested properties
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(name='traverseView',path='view',skip=False,type=vim.view.ContainerView)
+    objSpec = vmodl.query.PropertyCollector.ObjectSpec(obj=view,skip=True,selectSet=[traversal])
+    propSet = [vmodl.query.PropertyCollector.PropertySpec(type=aType,pathSet=paths,all=False) for aType,paths in propSpecs.items()]
+    filterSpec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[objSpec],propSet=propSet)
+
+    try:
+        result = retrieve_properties(content.propertyCollector,filterSpec)
+    finally:
+        view.Destroy()
+
+    return result
+
+def retrieve_properties(collector,filterSpec):
+    #run a filter spec, returns a list of dicts with the object under 'obj'
+    result = []
+
+    retrieved = collector.RetrievePropertiesEx(specSet=[filterSpec],options=vmodl.query.PropertyCollector.RetrieveOptions())
+
+    while(retrieved != None):
+        for anObj in retrieved.objects:
+            #unset properties (ie: a VM with no snapshots) are left out
+            props = {'obj':anObj.obj}
+            for aProp in anObj.propSet:
+                props[aProp.name] = aProp.val
+            result.append(props)
+
+        #large inventories come back in pages
+        if(retrieved.token == None):
+            break
+        retrieved = collector.ContinueRetrievePropertiesEx(token=retrieved.token)
+
+    return result
+
+def alarm_names(content,alarms):
+    """get the names of the given alarms in one property collector call
+    alarms aren't in the inventory so they can't come from the container view, returns names by alarm id"""
+    alarms = dict([(anAlarm._moId,anAlarm) for anAlarm in alarms])
+    if(len(alarms) == 0):
+        return {}
+
+    objSpecs = [vmodl.query.PropertyCollector.ObjectSpec(obj=anAlarm,skip=False) for anAlarm in alarms.values()]
+    propSpec = vmodl.query.PropertyCollector.PropertySpec(type=vim.alarm.Alarm,pathSet=['info.name'],all=False)
+    filterSpec = vmodl.query.PropertyCollector.FilterSpec(objectSet=objSpecs,propSet=[propSpec])
+
+    return dict([(anAlarm['obj']._moId,anAlarm['info.name']) for anAlarm in retrieve_properties(content.propertyCollector,filterSpec) if 'info.name' in anAlarm])
+
+def walk_snapshots(snapshotList):
+    #yield every snapshot in the tree, not just the roots
+    for aSnap in snapshotList:
+        yield aSnap
+        for aChild in walk_snapshots(aSnap.childSnapshotList):
+            yield aChild
+
+def load_counters(perfManager,cacheFile,ttl,refresh=False):
+    """map counter names (group.name.rollup) to their id and unit
+    the counter list is large and rarely changes so it is cached on disk"""
+    if(not refresh):
+        try:
+            if(time.time() - os.path.getmtime(cacheFile) < ttl):
+                with open(cacheFile,'r') as f:
+                    return json.load(f)
+        except (IOError,OSError,ValueError):
+            pass
+
+    counters = {}
+    for aCounter in perfManager.perfCounter:
+        name = '%s.%s.%s' % (aCounter.groupInfo.key,aCounter.nameInfo.key,aCounter.rollupType)
+        counters[name] = {'id':aCounter.key,'unit':aCounter.unitInfo.key}
+
+    #mkstemp picks an unused name, a file or link someone else made in the shared temp dir isn't written through
+    fd,tmpFile = tempfile.mkstemp(prefix=os.path.basename(cacheFile) + '.',dir=os.path.dirname(os.path.abspath(cacheFile)))
+    try:
+        with os.fdopen(fd,'w') as f:
+            json.dump(counters,f)
+        os.rename(tmpFile,cacheFile)
+    except:
+        os.remove(tmpFile)
+        raise
+
+    return counters
+
+def resolve_counters(perfManager,names,cacheFile,ttl):
+    counters = load_counters(perfManager,cacheFile,ttl)
+
+    #a name we don't know may be newer than the cache
+    if(len([aName for aName in names if aName not in counters]) > 0):
+        counters = load_counters(perfManager,cacheFile,ttl,True)
+
+    missing = [aName for aName in names if aName not in counters]
+    if(len(missing) > 0):
+        print "Unknown performance counters: " + ', '.join(missing)
+        sys.exit(UNKNOWN)
+
+    return {aName:counters[aName] for aName in names}
+
+def performance(perfManager,hosts,counters,warn,crit):
+    problems = {CRITICAL:[],WARNING:[]}
+    perfdata = []
+    found = set()
+
+    #one query for every host and metric, only the latest real-time sample
+    metricIds = [vim.PerformanceManager.MetricId(counterId=aCounter['id'],instance='') for aCounter in counters.values()]
+    querySpecs = [vim.PerformanceManager.QuerySpec(entity=aHost,metricId=metricIds,intervalId=20,maxSample=1) for hostName,aHost in hosts]
+
+    hostNames = {aHost._moId:hostName for hostName,aHost in hosts}
+    counterNames = {aCounter['id']:aName for aName,aCounter in counters.items()}
+
+    for aResult in perfManager.QueryPerf(querySpec=querySpecs):
+        hostName = hostNames[aResult.entity._moId]
+
+        for aSeries in aResult.value:
+            #only the aggregate was asked for, -1 is a sample vCenter doesn't have
+            if(aSeries.id.instance != '' or len(aSeries.value) == 0 or aSeries.value[-1] < 0):
+                continue
+
+            name = counterNames[aSeries.id.counterId]
+            found.add((hostName,name))
+            value = float(aSeries.value[-1])
+
+            #percentages come back in hundredths
+            if(counters[name]['unit'] == 'percent'):
+                value = value / 100
+
+            perfdata.append("'%s_%s'=%.2f;%s;%s" % (hostName,name,value,'' if warn == None else warn,'' if crit == None else crit))
+
+            if(crit != None and value > crit):
+                problems[CRITICAL].append(hostName + " " + name + " " + str(value))
+            elif(warn != None and value > warn):
+                problems[WARNING].append(hostName + " " + name + " " + str(value))
+
+    #every host and metric asked for needs a value, otherwise OK would only cover the ones that came back
+    missing = [hostName + " " + name for hostName,aHost in hosts for name in sorted(counters.keys()) if (hostName,name) not in found]
+
+    if(len(missing) > 0):
+        print "No performance data for " + ', '.join(missing) + " | " + ' '.join(perfdata)
+        sys.exit(UNKNOWN)
+    elif(len(problems[CRITICAL]) > 0):
+        print str(problems[CRITICAL]) + " | " + ' '.join(perfdata)
+        sys.exit(CRITICAL)
+    elif(len(problems[WARNING]) > 0):
+        print str(problems[WARNING]) + " | " + ' '.join(perfdata)
+        sys.exit(WARNING)
+    else:
+        print "Performance metrics OK | " + ' '.join(perfdata)
+        sys.exit(OK)
 
-    startTime = datetime.datetime.now() - datetime.timedelta(hours=1)
-    endTime = datetime.datetime.now()
+def status_result(overallStatus,alarmNames):
+    #returns the exit code and output lines for a host status
+    if(overallStatus == 'red'):
+        return (CRITICAL,['Host status is critical'] + alarmNames)
+    elif(overallStatus == 'yellow'):
+        return (WARNING,['Host status at a warning state'] + alarmNames)
+    else:
+        return (OK,['Host is OK'])
 
-    query = vim.PerformanceManager.QuerySpec(maxSample=1,
-                                                 entity=host,
-                                                 metricId=[metricId],
-                                                 startTime=startTime,
-                                                 endTime=endTime)
+def datastore_used(capacity,freeSpace):
+    #percent of the datastore in use, None when the capacity isn't known (ie: an inaccessible datastore)
+    if(not capacity):
+        return None
 
-    print perfManager.QueryPerf(querySpec=[query])
+    return (float(capacity - freeSpace) / capacity) * 100
 
 def overall_status(host):
+    exit_code,lines = status_result(host.overallStatus,[alarm.alarm.info.name for alarm in host.triggeredAlarmState])
 
-    if(host.overallStatus == 'red'):
-        print ('Host status is critical')
-        for alarm in host.triggeredAlarmState:
-            print (alarm.alarm.info.name)
+    for aLine in lines:
+        print (aLine)
 
-        sys.exit(CRITICAL)
-    elif(host.overallStatus == 'yellow'):
-        print ('Host status at a warning state')
-        for alarm in host.triggeredAlarmState:
-            print (alarm.alarm.info.name)
-
-        sys.exit(WARNING)
-    else:
-        print ('Host is OK')
-        sys.exit(OK)
+    sys.exit(exit_code)
 
 def datastores(host,warn,crit):
     critical_stores = []
     warning_stores = []
+    unknown_stores = []
     
     for aStore in host.datastore:
         #compute the disk usage
-        used = (float(aStore.summary.capacity - aStore.summary.freeSpace) / aStore.summary.capacity) * 100
+        used = datastore_used(aStore.summary.capacity,aStore.summary.freeSpace)
 
-        if(used > crit):
+        if(used == None):
+            unknown_stores.append(aStore.name + " capacity unknown")
+        elif(used > crit):
             critical_stores.append(aStore.name + " " + str(used) + "%")
         elif(used > warn):
             warning_stores.append(aStore.name + " " + str(used) + "%")
@@ -92,6 +324,9 @@ def datastores(host,warn,crit):
     elif(len(warning_stores) > 0):
         print warning_stores
         sys.exit(WARNING)
+    elif(len(unknown_stores) > 0):
+        print unknown_stores
+        sys.exit(UNKNOWN)
     else:
         print "Datastores all OK"
         sys.exit(OK)
@@ -100,15 +335,15 @@ def snapshots(vmList,warn,crit):
     outOfDate = []
     now = datetime.datetime.now(UTC())
     
-    for VM in vmList.view:
+    for VM in vmList:
         #check if this vm has a snapshot
-        if(VM.snapshot != None):
-            for aSnap in VM.snapshot.rootSnapshotList:
+        if(VM.get('snapshot') != None):
+            for aSnap in walk_snapshots(VM['snapshot'].rootSnapshotList):
                 #get the difference between these two days
                 tdelta = now - aSnap.createTime
                  
                 if(tdelta.days >= crit):
-                    outOfDate.append(VM.name + " - " + str(tdelta.days) + " days")
+                    outOfDate.append(VM['name'] + " - " + str(tdelta.days) + " days")
 
     if(len(outOfDate) > 0):
         print outOfDate
@@ -117,28 +352,99 @@ def snapshots(vmList,warn,crit):
         print "Snapshots OK"
         sys.exit(OK)
 
+def sweep(content,args):
+    results = []
+
+    #every host and datastore in one call, shared datastores only show up once
+    objects = collect_properties(content,{vim.HostSystem:['name','overallStatus','triggeredAlarmState'],
+                                          vim.Datastore:['name','summary.capacity','summary.freeSpace']})
+
+    #the names of every triggered alarm in one more call, rather than one call per alarm
+    alarmStates = [aState for anObj in objects for aState in anObj.get('triggeredAlarmState',[])]
+    names = alarm_names(content,[aState.alarm for aState in alarmStates])
+
+    for anObj in objects:
+        if(isinstance(anObj['obj'],vim.HostSystem)):
+            alarms = [names.get(aState.alarm._moId,aState.key) for aState in anObj.get('triggeredAlarmState',[])]
+            exit_code,lines = status_result(anObj.get('overallStatus'),alarms)
+            results.append((anObj['name'],args.host_service,exit_code,', '.join(lines)))
+        else:
+            used = datastore_used(anObj.get('summary.capacity'),anObj.get('summary.freeSpace'))
+
+            if(used == None):
+                results.append((args.datastore_host or args.service,args.datastore_service % anObj['name'],UNKNOWN,anObj['name'] + " capacity unknown"))
+                continue
+
+            exit_code = OK
+            if(used > args.critical):
+                exit_code = CRITICAL
+            elif(used > args.warning):
+                exit_code = WARNING
+
+            results.append((args.datastore_host or args.service,args.datastore_service % anObj['name'],exit_code,anObj['name'] + " " + str(used) + "%"))
+
+    if(args.output == 'passive'):
+        #write external commands so each host and datastore gets its own result
+        now = int(time.time())
+        with open(args.command_file,'a') as f:
+            for hostName,serviceName,exit_code,output in results:
+                f.write('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (now,hostName,serviceName,exit_code,output))
+
+        print "Submitted results for " + str(len(results)) + " hosts and datastores"
+        sys.exit(OK)
+    else:
+        worst = OK
+        for hostName,serviceName,exit_code,output in results:
+            print hostName + " " + serviceName + ": " + output
+            worst = max(worst,exit_code)
+
+        sys.exit(worst)
+
 def main():
 
     args = get_args()
 
     #connect to vCenter
     host = None
-    service_instance = connect.SmartConnect(host=args.service,user=args.user,pwd=args.password,port=args.port)
-
-    if not service_instance:
-        print "Could not connect to vcenter"
-        sys.exit(-1)
-
-    atexit.register(connect.Disconnect,service_instance)
+    service_instance = connect_vcenter(args)
 
     #get the content from vcenter
     content = service_instance.RetrieveContent()
 
     if(args.type == 'snapshot'):
-        #get all vms
-        all_vms = content.viewManager.CreateContainerView(content.rootFolder,[vim.VirtualMachine],True)
+        #get the name and snapshot tree of all vms at once
+        all_vms = collect_properties(content,{vim.VirtualMachine:['name','snapshot']})
         
         snapshots(all_vms,args.warning,args.critical)
+    elif(args.type == 'sweep'):
+        if(args.warning == None or args.critical == None):
+            print "Sweep needs warning and critical datastore values"
+            sys.exit(UNKNOWN)
+
+        sweep(content,args)
+    elif(args.type == 'perf'):
+        if(args.metric == None):
+            print "Perf needs at least one metric"
+            sys.exit(UNKNOWN)
+
+        #check the given host or every host
+        if(args.host != None):
+            host = content.searchIndex.FindByDnsName(dnsName=args.host, vmSearch=False)
+
+            if(host == None):
+                print "Host " + args.host + " cannot be found"
+                sys.exit(CRITICAL)
+
+            hosts = [(args.host,host)]
+        else:
+            hosts = [(aHost['name'],aHost['obj']) for aHost in collect_properties(content,{vim.HostSystem:['name']})]
+
+        counterCache = args.counter_cache
+        if(counterCache == None):
+            counterCache = os.path.join(tempfile.gettempdir(),'check_vmware_counters_%s.json' % args.service)
+
+        counters = resolve_counters(content.perfManager,args.metric,counterCache,args.counter_ttl)
+        performance(content.perfManager,hosts,counters,args.warning,args.critical)
     else:
         #find the host
         search_index = content.searchIndex
@@ -3,7 +3,12 @@
 import argparse
 import json
 import sys
+import os
+import time
+import fcntl
+import tempfile
 import requests
+from multiprocessing.pool import ThreadPool
 from requests.auth import HTTPDigestAuth
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
@@ -13,10 +18,23 @@ requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 class HttpGetter:
     address = ''
     secret = ''
+    cacheFile = ''
+    cacheTTL = 0
+    timeout = None
+    http = None
     
-    def __init__(self,host,port,password):
+    def __init__(self,host,port,password,cacheTTL=0,timeout=None):
         self.address = 'https://%s:%i/api/' % (host,port)
         self.secret = password
+        self.timeout = timeout
+
+        #keep the connection and digest nonce for every request to this router
+        self.http = requests.Session()
+        self.http.auth = self.getAuth()
+
+        #the status document can be shared by checks against the same router
+        self.cacheTTL = cacheTTL
+        self.cacheFile = os.path.join(tempfile.gettempdir(),'cradlepoint_%s_%i.json' % (host,port))
         
     def getAddress(self):
         return self.address
@@ -25,7 +43,7 @@ class HttpGetter:
         return HTTPDigestAuth("admin", self.secret)
 
     def findVZWInfo(self,json):
-        radios = json['data']['status']['wan']['devices']
+        radios = json['data']
 
         result = None
         for aName in list(radios.keys()):
@@ -35,13 +53,66 @@ class HttpGetter:
 
         return result
 
-    def getJSON(self):
+    def getJSON(self,path=''):
+        #checks only need one branch of the tree, ie: status/wlan
+        if(self.cacheTTL > 0 and path.split('/')[0] == 'status'):
+            result = self._getCachedStatus()
+
+            for aKey in path.split('/')[1:]:
+                result = result[aKey]
+
+            return {'success':True,'data':result}
+        else:
+            return self._get(path)
+
+    def _getCachedStatus(self):
+        #hold the lock while fetching so other checks wait for this document
+        lockFile = open(self.cacheFile + '.lock','a')
+        try:
+            fcntl.flock(lockFile,fcntl.LOCK_EX)
+
+            try:
+                if(time.time() - os.path.getmtime(self.cacheFile) < self.cacheTTL):
+                    with open(self.cacheFile,'r') as f:
+                        return json.load(f)
+            except (IOError,OSError,ValueError):
+                pass
+
+            status = self._get('status')
+            if(status == None):
+                print 'UNKNOWN - Cradlepoint device did not return a status document'
+                sys.exit(3)
+
+            result = status['data']
+
+            #mkstemp picks an unused name, a file or link someone else made in the shared temp dir isn't written through
+            fd,tmpFile = tempfile.mkstemp(prefix=os.path.basename(self.cacheFile) + '.',dir=os.path.dirname(os.path.abspath(self.cacheFile)))
+            try:
+                with os.fdopen(fd,'w') as f:
+                    json.dump(result,f)
+                os.rename(tmpFile,self.cacheFile)
+            except:
+                os.remove(tmpFile)
+                raise
+
+            return result
+        finally:
+            lockFile.close()
+
+    def fetch(self,path):
+        #raises on any error, the caller decides how to report it
+        r = self.http.get(self.getAddress() + path,verify=False,timeout=self.timeout)
+        r.raise_for_status()
+
+        return r.json()
+
+    def _get(self,path):
 
         try:
-            r = requests.get(
-                self.getAddress(),
-                auth=self.getAuth(),
-                verify=False
+            r = self.http.get(
+                self.getAddress() + path,
+                verify=False,
+                timeout=self.timeout
             )
         except:
             print 'UNKNOWN - Error when contacting Cradlepoint device: ' + str(sys.exc_info())
@@ -58,17 +129,30 @@ class HttpGetter:
 def main():
 
     parser = argparse.ArgumentParser(description="Checks Cradlepoint 600 Modem via Http API")
-    parser.add_argument('-H','--host',required=True,type=str,help='Modem IP to check')
-    parser.add_argument('-P','--port',required=True,type=int,help="Port of HTTP service")
-    parser.add_argument('-p','--password',required=True,type=str,help="Password to authenticate")
-    parser.add_argument('-t','--type',required=True,type=str,help="Type of check to perform (wifi|vpn|imei|phone|signal)")
+    parser.add_argument('-H','--host',required=False,type=str,help='Modem IP to check')
+    parser.add_argument('-P','--port',required=False,type=int,help="Port of HTTP service")
+    parser.add_argument('-p','--password',required=False,type=str,help="Password to authenticate")
+    parser.add_argument('-t','--type',required=False,type=str,help="Type of check to perform (wifi|vpn|imei|phone|signal)")
     parser.add_argument('-T','--tunnel',required=False,type=str,help="Tunnel name if using VPN check")
     parser.add_argument('-c','--critical',required=False,type=int,help="critical value")
     parser.add_argument('-w','--warning',required=False,type=int,help="warning value")
+    parser.add_argument('-C','--cache',required=False,type=int,default=0,help="Seconds to share the status document between checks, default 0 (off)")
+    parser.add_argument('-f','--fleet',required=False,type=str,help="Inventory file of routers to check together, one per line as: host port password [tunnel] [name=icinga host]")
+    parser.add_argument('-W','--workers',required=False,type=int,default=10,help="Routers to poll at once in fleet mode")
+    parser.add_argument('--timeout',required=False,type=int,default=30,help="Seconds to wait on each router")
+    parser.add_argument('--wifi',required=False,type=int,help="Critical wifi state in fleet mode, 1 for on or 0 for off")
+    parser.add_argument('-o','--output',required=False,type=str,choices=['lines','passive'],default='lines',help="Fleet mode output, one line per check or passive check results")
+    parser.add_argument('--command-file',required=False,type=str,default='/var/run/icinga2/cmd/icinga2.cmd',help="External command file for passive results")
     
     args = parser.parse_args(sys.argv[1:])
 
-    host = HttpGetter(args.host,args.port,args.password)
+    if(args.fleet != None):
+        check_fleet(args)
+
+    if(args.host == None or args.port == None or args.password == None or args.type == None):
+        parser.error('--host, --port, --password and --type are required unless --fleet is given')
+
+    host = HttpGetter(args.host,args.port,args.password,args.cache,args.timeout)
 
     if(args.type == 'wifi'):
         check_wifi(host,args.critical)
@@ -84,87 +168,164 @@ def main():
         print "Unknown type: " + args.type
         sys.exit(3)
 
-def check_wifi(host,critical):
-    json = host.getJSON()
-
+def wifi_result(wlan,critical):
     #check if the wifi radio is on
-    status = json['data']['status']['wlan']['state']
-
-    print "Wifi Radio is " + status
+    status = wlan['state']
+    output = "Wifi Radio is " + status
 
     #if on and we don't want it on
     if(status == 'On' and critical == 1):
-        sys.exit(1)
+        return (1,output)
     #if off and we don't want it off
     elif (status == 'Off' and critical == 0):
-        sys.exit(1)
+        return (1,output)
     else:
-        sys.exit(0)
-
-def check_vpn(host,tunnel):
-    json = host.getJSON()
+        return (0,output)
 
+def vpn_result(tunnels,tunnel):
     #find the tunnel
     tunnelObj = None
 
-    for aTunnel in json['data']['status']['vpn']['tunnels']:
+    for aTunnel in tunnels:
         if(aTunnel['name'] == tunnel):
             tunnelObj = aTunnel
 
     if(tunnelObj != None):
         if(len(tunnelObj['connections']) < 1 or tunnelObj['connections'][0]['state'] != 'mature'):
-            print tunnelObj['name'] + " is down"
-            sys.exit(2)
+            return (2,tunnelObj['name'] + " is down")
         else:
-            print tunnelObj['name'] + " is up"
-            sys.exit(0)
+            return (0,tunnelObj['name'] + " is up")
     else:
-        print tunnel + ' is not a valid name'
-        sys.exit(3)
-
-def get_imei(host):
-    json = host.getJSON()
-
-    radio = host.findVZWInfo(json)
+        return (3,tunnel + ' is not a valid name')
 
+def imei_result(radio):
     if(radio != None):
-        print radio['diagnostics']['DISP_IMEI']
-        sys.exit(0)
+        return (0,radio['diagnostics']['DISP_IMEI'])
     else:
-        print "Can't find radio information"
-        sys.exit(3)
-
-def get_phone(host):
-    json = host.getJSON()
-
-    radio = host.findVZWInfo(json)
+        return (3,"Can't find radio information")
 
+def phone_result(radio):
     if(radio != None):
-        print radio['diagnostics']['MDN']
-        sys.exit(0)
+        return (0,radio['diagnostics']['MDN'])
     else:
-        print "Can't find radio information"
-        sys.exit(3)
-
-def get_signal(host,warn,crit):
-    json = host.getJSON()
-
-    radio = host.findVZWInfo(json)
+        return (3,"Can't find radio information")
 
+def signal_result(radio,warn,crit):
     if(radio != None):
 
         signal = int(radio['status']['signal_strength'])
-        print  str(signal) + "%"
+        output = str(signal) + "%"
         
         if(signal <= crit):
-            sys.exit(2)
+            return (2,output)
         elif(signal <= warn):
-            sys.exit(1)
+            return (1,output)
         else:
-            sys.exit(0)
+            return (0,output)
     else:
-        print "Can't find radio information"
+        return (3,"Can't find radio information")
+
+def print_result(result):
+    print result[1]
+    sys.exit(result[0])
+
+def check_wifi(host,critical):
+    json = host.getJSON('status/wlan')
+
+    print_result(wifi_result(json['data'],critical))
+
+def check_vpn(host,tunnel):
+    json = host.getJSON('status/vpn/tunnels')
+
+    print_result(vpn_result(json['data'],tunnel))
+
+def get_imei(host):
+    json = host.getJSON('status/wan/devices')
+
+    print_result(imei_result(host.findVZWInfo(json)))
+
+def get_phone(host):
+    json = host.getJSON('status/wan/devices')
+
+    print_result(phone_result(host.findVZWInfo(json)))
+
+def get_signal(host,warn,crit):
+    json = host.getJSON('status/wan/devices')
+
+    print_result(signal_result(host.findVZWInfo(json),warn,crit))
+
+def read_inventory(path):
+    #one router per line: host port password [tunnel] [name=icinga host]
+    result = []
+
+    with open(path,'r') as f:
+        for line in f:
+            fields = line.split('#')[0].split()
+
+            #the Icinga host name for passive results, defaults to the address
+            names = [aField[5:] for aField in fields if aField.startswith('name=')]
+            fields = [aField for aField in fields if not aField.startswith('name=')]
+
+            if(len(fields) > 0):
+                if(len(fields) < 3):
+                    raise ValueError('Expected host port password on line: ' + line.strip())
+
+                result.append({'host':fields[0],'port':int(fields[1]),'password':fields[2],'tunnel':fields[3] if len(fields) > 3 else None,'name':names[0] if len(names) > 0 else fields[0]})
+
+    return result
+
+def poll_router(router,args):
+    #one status fetch per router, every check runs against it
+    results = []
+
+    try:
+        host = HttpGetter(router['host'],router['port'],router['password'],0,args.timeout)
+        status = host.fetch('status')['data']
+        radio = host.findVZWInfo({'data':status['wan']['devices']})
+
+        results.append(('wifi',wifi_result(status['wlan'],args.wifi)))
+        if(router['tunnel'] != None):
+            results.append(('vpn',vpn_result(status['vpn']['tunnels'],router['tunnel'])))
+        results.append(('imei',imei_result(radio)))
+        results.append(('phone',phone_result(radio)))
+        if(args.warning != None and args.critical != None):
+            results.append(('signal',signal_result(radio,args.warning,args.critical)))
+    except Exception:
+        results.append(('status',(3,'UNKNOWN - Error when contacting Cradlepoint device: ' + str(sys.exc_info()[1]))))
+
+    return results
+
+def check_fleet(args):
+    try:
+        routers = read_inventory(args.fleet)
+    except (IOError,ValueError) as e:
+        print 'UNKNOWN - Error reading ' + args.fleet + ': ' + str(e)
         sys.exit(3)
 
+    #poll the routers together, each one has its own connection and timeout
+    pool = ThreadPool(max(1,min(args.workers,len(routers))))
+    try:
+        results = pool.map(lambda router: poll_router(router,args),routers)
+    finally:
+        pool.terminate()
+
+    if(args.output == 'passive'):
+        now = int(time.time())
+        with open(args.command_file,'a') as f:
+            for router,routerResults in zip(routers,results):
+                for checkName,(exitCode,output) in routerResults:
+                    f.write('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;Cradlepoint %s;%d;%s\n' % (now,router['name'],checkName,exitCode,output))
+
+        print 'Submitted results for ' + str(len(routers)) + ' routers'
+        sys.exit(0)
+    else:
+        worst = 0
+        for router,routerResults in zip(routers,results):
+            for checkName,(exitCode,output) in routerResults:
+                print router['name'] + ' ' + checkName + ': ' + str(output)
+                worst = max(worst,exitCode)
+
+        sys.exit(worst)
+
 if __name__ == '__main__':
     main()
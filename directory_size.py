@@ -3,70 +3,323 @@ import os
 import os.path
 import math
 import argparse
+import gzip
+import heapq
+import json
+import queue
+import threading
 
-#parse the arguments
-parser = argparse.ArgumentParser()
-parser.add_argument('-p','--path',required=True,help='The path to start parsing')
-parser.add_argument('-s','--sort',required=False,help='How to sort the list (alpha, size)',type=str,choices=['alpha','size'],default='alpha')
-parser.add_argument('-u','--units',required=False,help='Units to use for display, default=GB',type=str,choices=['KB','MB','GB'],default='GB')
-args = parser.parse_args()
+#load a saved directory index, returns an empty index if there isn't a usable one for this path
+def loadIndex(indexFile,aPath,top=0,maxKeys=1000):
+    try:
+        with gzip.open(indexFile,'rt') as f:
+            saved = json.load(f)
+
+        #the largest files and extensions kept per directory depend on --top and --max-keys
+        if(saved['root'] == aPath and saved['top'] == top and saved['keys'] == maxKeys):
+            return saved['dirs']
+    except (OSError,ValueError,KeyError):
+        pass
+
+    return {}
+
+#save the directory index, written to a temp file first so a failed run keeps the old one
+def saveIndex(indexFile,aPath,index,top=0,maxKeys=1000):
+    tmpFile = '%s.%d' % (indexFile,os.getpid())
+    with gzip.open(tmpFile,'wt') as f:
+        json.dump({'root':aPath,'top':top,'keys':maxKeys,'dirs':index},f,separators=(',',':'))
+
+    os.replace(tmpFile,indexFile)
+
+#bucket for extensions past the key limit
+OTHER_KEY = '(other)'
+
+#fold all but the maxKeys largest keys in to the other bucket, ties go by key so the same totals always keep the same keys
+def trimCapped(sizes,maxKeys):
+    keys = sorted([k for k in sizes if k != OTHER_KEY],key=lambda k: (-sizes[k],k))
+
+    for aKey in keys[maxKeys:]:
+        sizes[OTHER_KEY] = sizes.get(OTHER_KEY,0) + sizes.pop(aKey)
+
+#add to a size total by key, past twice maxKeys keys the smallest are folded in to the other bucket
+#the slack means the sort is only done once per maxKeys new keys, trimCapped gives the final list
+def addCapped(sizes,key,size,maxKeys):
+    sizes[key] = sizes.get(key,0) + size
+
+    if(len(sizes) > maxKeys * 2):
+        trimCapped(sizes,maxKeys)
+
+#the totals from a walk, results from other walks (threads, processes, mounts) can be merged in
+class SizeResult:
+
+    def __init__(self,maxKeys=1000,top=0):
+        self.totalSize = 0 # the total size in bytes
+        self.extList = {} #list of extensions and the total size
+        self.dirSizes = {} #cumulative size of each directory, down to the depth given
+        self.largest = [] #heap of the largest (size, path) files found
+        self.maxKeys = maxKeys #most extensions to keep before using the other bucket
+        self.top = top #how many of the largest files to keep
+
+    #add the totals for a single directory
+    def addDir(self,total,extSizes):
+        self.totalSize = self.totalSize + total
+
+        for fExt,fSize in extSizes.items():
+            addCapped(self.extList,fExt,fSize,self.maxKeys)
+
+    #add to the cumulative size of a directory
+    def addDirSize(self,aDir,total):
+        self.dirSizes[aDir] = self.dirSizes.get(aDir,0) + total
+
+    #keep only the largest files, the smallest of them is at the top of the heap to be pushed out
+    def addFile(self,fSize,fPath):
+        pushLargest(self.largest,fSize,fPath,self.top)
+
+    #combine another result into this one
+    def merge(self,other):
+        self.addDir(other.totalSize,other.extList)
+
+        for aDir,dirSize in other.dirSizes.items():
+            self.addDirSize(aDir,dirSize)
+
+        for fSize,fPath in other.largest:
+            self.addFile(fSize,fPath)
+
+        return self
+
+#push a file on to a heap holding at most top files
+def pushLargest(heap,fSize,fPath,top):
+    if(len(heap) < top):
+        heapq.heappush(heap,(fSize,fPath))
+    elif(top > 0 and fSize > heap[0][0]):
+        heapq.heappushpop(heap,(fSize,fPath))
 
 class FileCounter:
-    totalSize = 0 # the total size in bytes
-    extList = {} #list of extensions and the total size
+
+    def __init__(self,maxKeys=1000,top=0):
+        self.maxKeys = maxKeys
+        self.top = top
+        self.result = SizeResult(maxKeys,top)
 
     #returns the size in bytes converted to the unit given
     def convertSize(self,byteSize,unit='MB'):
         units = {'KB': 1024, 'MB': math.pow(1024,2),'GB':math.pow(1024,3)}
-        
+
         return byteSize/units[unit]
-    
-    #walk the given path, recording the file size
-    def walkPath(self,aPath):
-        for (dirPath, dirs, files) in os.walk(aPath):
-            for aFile in files:
-                #get the size and ext
-                fSize = os.path.getsize(os.path.join(dirPath,aFile))
-                self.totalSize = self.totalSize + fSize
-                fName,fExt = os.path.splitext(aFile)
-            
-                if(fExt != None):
-                    fExt = fExt.lower()
-                    
-                    #temp files are the ext
-                    if(fExt == ''):
-                        fExt = fName.lower()
-                        
-                    #if the extension already exists, add to it, otherwise just set it
-                    if(fExt in self.extList):
-                        self.extList[fExt] = self.extList[fExt] + fSize
-                    else:
-                        self.extList[fExt] = fSize
+
+    #get the extension a file is counted under
+    def _extKey(self,aFile):
+        fName,fExt = os.path.splitext(aFile)
+        fExt = fExt.lower()
+
+        #temp files are the ext
+        if(fExt == ''):
+            fExt = fName.lower()
+
+        return fExt
+
+    #list a single directory, returns [mtime, total size, {ext: size}, [subdirectory names], [largest (size, path) files]]
+    #if the directory hasn't changed since the cached entry was made the cached entry is returned as is
+    def _scanDir(self,aPath,cached=None):
+        extSizes = {}
+        dirs = []
+        largest = []
+        total = 0
+
+        try:
+            #stat before listing so a change made during the listing is picked up next time
+            mtime = os.stat(aPath).st_mtime_ns
+
+            if(cached != None and cached[0] == mtime):
+                return cached
+
+            with os.scandir(aPath) as entries:
+                for entry in entries:
+                    try:
+                        if(entry.is_dir()):
+                            #like os.walk, don't follow links to directories
+                            if(not entry.is_symlink()):
+                                dirs.append(entry.name)
+                        else:
+                            #reuse the entry rather than joining the path and calling stat again
+                            fSize = entry.stat().st_size
+                            fExt = self._extKey(entry.name)
+
+                            total = total + fSize
+                            addCapped(extSizes,fExt,fSize,self.maxKeys)
+
+                            if(self.top > 0):
+                                pushLargest(largest,fSize,entry.path,self.top)
+                    except OSError:
+                        #broken links or files removed mid walk
+                        pass
+        except OSError:
+            #unreadable directories are skipped, same as os.walk
+            mtime = None
+
+        trimCapped(extSizes,self.maxKeys)
+
+        return [mtime,total,extSizes,dirs,largest]
+
+    #list directories from the queue until told to stop
+    def _scanWorker(self,dirQueue,resultQueue):
+        while(True):
+            item = dirQueue.get()
+
+            if(item == None):
+                break
+
+            aPath,cached = item
+            try:
+                entry = self._scanDir(aPath,cached)
+            except Exception:
+                #walkPath waits for a result for every directory, so post an empty one that isn't indexed
+                entry = [None,0,{},[],[]]
+
+            resultQueue.put((aPath,entry))
+
+    #add a directory's own size to it and each parent directory down to the depth being kept
+    def _addDirSize(self,result,root,dirPath,total,depth):
+        parts = [] if dirPath == root else os.path.relpath(dirPath,root).split(os.sep)
+
+        for i in range(0,min(len(parts),depth) + 1):
+            result.addDirSize(os.path.join(root,*parts[:i]),total)
+
+    #walk the given path, adding the file sizes to this counter's result
+    #give an index from a previous walk to only list directories that changed since then
+    #depth is how many levels of directory sizes to keep
+    def walkPath(self,aPath,workers=8,index=None,depth=0):
+        newIndex = {}
+        if(index == None):
+            index = {}
+
+        result = SizeResult(self.maxKeys,self.top)
+
+        #directories are listed by the workers, results are added up here so no locking is needed
+        dirQueue = queue.Queue()
+        resultQueue = queue.Queue()
+
+        threads = [threading.Thread(target=self._scanWorker,args=(dirQueue,resultQueue)) for i in range(0,max(1,workers))]
+        for aThread in threads:
+            aThread.daemon = True
+            aThread.start()
+
+        dirQueue.put((aPath,index.get(aPath)))
+        outstanding = 1
+
+        try:
+            while(outstanding > 0):
+                dirPath,entry = resultQueue.get()
+                outstanding = outstanding - 1
+
+                result.addDir(entry[1],entry[2])
+                self._addDirSize(result,aPath,dirPath,entry[1],depth)
+
+                for fSize,fPath in entry[4]:
+                    result.addFile(fSize,fPath)
+
+                if(entry[0] != None):
+                    newIndex[dirPath] = entry
+
+                #unchanged directories still have their subdirectories checked
+                for aDir in entry[3]:
+                    subPath = os.path.join(dirPath,aDir)
+                    dirQueue.put((subPath,index.get(subPath)))
+                    outstanding = outstanding + 1
+        finally:
+            for aThread in threads:
+                dirQueue.put(None)
+
+        self.result.merge(result)
+
+        return newIndex
+
+    #add the result of a walk done somewhere else (another counter, thread or process)
+    def merge(self,result):
+        self.result.merge(result)
 
     def getTotalSize(self,unit='MB'):
-        return self.convertSize(self.totalSize,unit)
+        return self.convertSize(self.result.totalSize,unit)
 
     def getExtensions(self,sort='key'):
+        extList = self.result.extList
+        trimCapped(extList,self.maxKeys)
+
         if(sort == 'key'):
-            return {k:self.extList[k] for k in sorted(self.extList.keys())}
+            return {k:extList[k] for k in sorted(extList.keys())}
         else:
-            return {k:v for k,v in sorted(self.extList.items(), key=lambda item: item[1], reverse=True)}
-                        
-fCounter = FileCounter()
-fCounter.walkPath(args.path)
-
-print('Getting files from: %s' % args.path)
-#print the total
-print("Total directory size: %.3f%s" % (fCounter.getTotalSize(args.units),args.units))
-print('')
-if(args.sort == 'alpha'):
-    print('Files by extension type')
-    fileList = fCounter.getExtensions().items()
-
-else:
-    print('Files by extension type, sorted by size')
-    fileList = fCounter.getExtensions('value').items()
-    
-for anExt,extSize in fileList:
-    print("%s : %.3f%s" % (anExt,fCounter.convertSize(extSize,args.units),args.units))
-        
+            return {k:v for k,v in sorted(extList.items(), key=lambda item: item[1], reverse=True)}
+
+    #directory sizes, largest first
+    def getDirectories(self):
+        return sorted(self.result.dirSizes.items(), key=lambda item: item[1], reverse=True)
+
+    #largest files as (path, size), largest first
+    def getLargestFiles(self):
+        return [(fPath,fSize) for fSize,fPath in sorted(self.result.largest, reverse=True)]
+
+def main():
+    #parse the arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p','--path',required=True,help='The path to start parsing')
+    parser.add_argument('-s','--sort',required=False,help='How to sort the list (alpha, size)',type=str,choices=['alpha','size'],default='alpha')
+    parser.add_argument('-u','--units',required=False,help='Units to use for display, default=GB',type=str,choices=['KB','MB','GB'],default='GB')
+    parser.add_argument('-w','--workers',required=False,help='Directories to list at once, raise this for network shares, default=8',type=int,default=8)
+    parser.add_argument('-d','--depth',required=False,help='Show the size of each directory down to this many levels, default=0 (off)',type=int,default=0)
+    parser.add_argument('-t','--top',required=False,help='Show this many of the largest files, default=0 (off)',type=int,default=0)
+    parser.add_argument('-k','--max-keys',required=False,help='Most extensions to list before grouping the rest as (other), default=1000',type=int,default=1000)
+    parser.add_argument('-f','--format',required=False,help='Output format (text, json), json sizes are in bytes',type=str,choices=['text','json'],default='text')
+    parser.add_argument('-i','--index',required=False,help='Index file from the last run, only directories whose modified time changed are listed again. Files changed in place are not seen until their directory changes',type=str)
+    args = parser.parse_args()
+
+    index = None
+    if(args.index != None):
+        index = loadIndex(args.index,args.path,args.top,args.max_keys)
+
+    fCounter = FileCounter(args.max_keys,args.top)
+    newIndex = fCounter.walkPath(args.path,args.workers,index,args.depth)
+
+    if(args.index != None):
+        saveIndex(args.index,args.path,newIndex,args.top,args.max_keys)
+
+    if(args.format == 'json'):
+        result = {'path':args.path,'total':fCounter.result.totalSize,
+                  'extensions':fCounter.getExtensions('value' if args.sort == 'size' else 'key')}
+
+        if(args.depth > 0):
+            result['directories'] = dict(fCounter.getDirectories())
+        if(args.top > 0):
+            result['largest_files'] = [{'path':fPath,'size':fSize} for fPath,fSize in fCounter.getLargestFiles()]
+
+        print(json.dumps(result,indent=2))
+        return
+
+    print('Getting files from: %s' % args.path)
+    #print the total
+    print("Total directory size: %.3f%s" % (fCounter.getTotalSize(args.units),args.units))
+    print('')
+    if(args.sort == 'alpha'):
+        print('Files by extension type')
+        fileList = fCounter.getExtensions().items()
+
+    else:
+        print('Files by extension type, sorted by size')
+        fileList = fCounter.getExtensions('value').items()
+
+    for anExt,extSize in fileList:
+        print("%s : %.3f%s" % (anExt,fCounter.convertSize(extSize,args.units),args.units))
+
+    if(args.depth > 0):
+        print('')
+        print('Directories by size')
+        for aDir,dirSize in fCounter.getDirectories():
+            print("%s : %.3f%s" % (aDir,fCounter.convertSize(dirSize,args.units),args.units))
+
+    if(args.top > 0):
+        print('')
+        print('Largest files')
+        for aFile,fSize in fCounter.getLargestFiles():
+            print("%s : %.3f%s" % (aFile,fCounter.convertSize(fSize,args.units),args.units))
+
+if __name__ == '__main__':
+    main()
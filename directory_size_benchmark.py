@@ -0,0 +1,88 @@
+"""Time the directory_size.py walker against a plain os.walk on a generated (or existing) directory tree"""
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import argparse
+from directory_size import FileCounter
+
+EXTENSIONS = ['.txt','.pdf','.docx','.xlsx','.jpg','.tmp','']
+
+def generateTree(aPath,depth,dirs,files):
+    #create files of a few KB each, sparse so generation stays quick
+    for i in range(0,files):
+        with open(os.path.join(aPath,'file%d%s' % (i,EXTENSIONS[i % len(EXTENSIONS)])),'wb') as f:
+            f.truncate(1024 * (i + 1))
+
+    if(depth > 0):
+        for i in range(0,dirs):
+            subDir = os.path.join(aPath,'dir%d' % i)
+            os.mkdir(subDir)
+            generateTree(subDir,depth - 1,dirs,files)
+
+def osWalkSize(aPath):
+    #the walk directory_size.py used to do
+    totalSize = 0
+    for (dirPath, dirs, files) in os.walk(aPath):
+        for aFile in files:
+            totalSize = totalSize + os.path.getsize(os.path.join(dirPath,aFile))
+
+    return totalSize
+
+def counterSize(aPath,workers):
+    fCounter = FileCounter()
+    fCounter.walkPath(aPath,workers)
+
+    return fCounter.result.totalSize
+
+def indexedSize(aPath,workers,index):
+    fCounter = FileCounter()
+    fCounter.walkPath(aPath,workers,index)
+
+    return fCounter.result.totalSize
+
+def timeIt(func,*args):
+    start = time.perf_counter()
+    result = func(*args)
+
+    return (time.perf_counter() - start,result)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the directory_size.py walker')
+    parser.add_argument('-p','--path',required=False,help='Existing path to walk instead of a generated tree')
+    parser.add_argument('-d','--depth',required=False,type=int,default=4,help='Depth of the generated tree, default=4')
+    parser.add_argument('-D','--dirs',required=False,type=int,default=6,help='Subdirectories per directory, default=6')
+    parser.add_argument('-f','--files',required=False,type=int,default=20,help='Files per directory, default=20')
+    parser.add_argument('-w','--workers',required=False,type=int,action='append',help='Worker counts to try, can be more than one, default 1 and 8')
+    args = parser.parse_args()
+
+    workers = args.workers if args.workers else [1,8]
+
+    tmpDir = None
+    aPath = args.path
+    if(aPath == None):
+        tmpDir = tempfile.mkdtemp(prefix='directory_size_')
+        aPath = tmpDir
+
+        seconds,result = timeIt(generateTree,aPath,args.depth,args.dirs,args.files)
+        print('Generated tree in %.2fs' % seconds)
+
+    try:
+        seconds,expected = timeIt(osWalkSize,aPath)
+        print('os.walk + getsize: %8.3fs' % seconds)
+
+        for count in workers:
+            seconds,result = timeIt(counterSize,aPath,count)
+            print('scandir %2d workers: %8.3fs%s' % (count,seconds,'' if result == expected else ' (size mismatch)'))
+
+        #a second walk with nothing changed only has to stat the directories
+        index = FileCounter().walkPath(aPath,workers[-1])
+        seconds,result = timeIt(indexedSize,aPath,workers[-1],index)
+        print('indexed %2d workers: %8.3fs%s' % (workers[-1],seconds,'' if result == expected else ' (size mismatch)'))
+    finally:
+        if(tmpDir != None):
+            shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    main()
@@ -3,116 +3,648 @@
 For more information on protocol and password compatability see this chart:
 http://deployingradius.com/documents/protocols/compatibility.html
 """
-import argparse, binascii, hashlib, pandas, re, sys
+import argparse, binascii, concurrent.futures, csv, filecmp, gzip, hashlib, json, os, re, shutil, sqlite3, struct, sys
+
+# pandas takes longer to import than a small spreadsheet takes to process, it is only imported for the pandas reader
+pandas = None
 
 __author__ = "Rob Weber"
 __email__ = "rweber@ecec.com"
-__version__ = "1.2"
+__version__ = "1.3"
 
 RECORD_TYPES = ['generic', 'phone']
 PASSWORD_TYPES = ['clear', 'md5', 'nt', 'none']
 PASSWORD_MATRIX = {'clear': 'Cleartext-Password', 'md5': 'MD5-Password', 'nt': 'NT-Password'}
+PHONE_AVPAIR = 'device-traffic-class = voice'
+PHONE_REPLY = f'Cisco-AVPair = "{PHONE_AVPAIR}"'
 
-def is_mac(username):
-  return re.search("^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$", username.strip())
+MAC_PATTERN = "^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$"
+HASH_BATCH = 5000
 
-def generate_control_pairs(controls):
-  if(len(controls) > 0):
-    return ", " + ', '.join(controls)
-  else:
-    return ""
+# most usernames in one IN (...) lookup, older SQLite builds allow 999 variables in a statement
+SQL_BATCH = 999
+
+# values pandas reads as missing, the csv reader treats them the same way
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>',
+             'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+# rlm_sql tables, same layout as the freeradius sqlite schema
+SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS radcheck (
+  id integer PRIMARY KEY,
+  username varchar(64) NOT NULL default '',
+  attribute varchar(64) NOT NULL default '',
+  op char(2) NOT NULL default '==',
+  value varchar(253) NOT NULL default ''
+);
+CREATE INDEX IF NOT EXISTS check_username ON radcheck(username);
+CREATE TABLE IF NOT EXISTS radreply (
+  id integer PRIMARY KEY,
+  username varchar(64) NOT NULL default '',
+  attribute varchar(64) NOT NULL default '',
+  op char(2) NOT NULL default '=',
+  value varchar(253) NOT NULL default ''
+);
+CREATE INDEX IF NOT EXISTS reply_username ON radreply(username);
+-- not used by freeradius, a digest of the pairs last written for each user so unchanged users are skipped without reading their rows
+CREATE TABLE IF NOT EXISTS raddigest (
+  username varchar(64) PRIMARY KEY,
+  digest char(64) NOT NULL
+);
+"""
+
+def md4_hexdigest(data):
+  # pure python MD4 (RFC 1320) for OpenSSL builds that don't provide it
+  mask = 0xffffffff
+  rounds = [(lambda x, y, z: (x & y) | (~x & z), 0, range(16), (3, 7, 11, 19)),
+            (lambda x, y, z: (x & y) | (x & z) | (y & z), 0x5a827999, [0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14, 3, 7, 11, 15], (3, 5, 9, 13)),
+            (lambda x, y, z: x ^ y ^ z, 0x6ed9eba1, [0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15], (3, 9, 11, 15))]
+
+  # pad to a multiple of 64 bytes with the bit length at the end
+  message = bytearray(data) + b'\x80'
+  message += b'\x00' * ((56 - len(message)) % 64)
+  message += struct.pack('<Q', (8 * len(data)) & 0xffffffffffffffff)
+
+  state = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+  for offset in range(0, len(message), 64):
+    words = struct.unpack('<16I', message[offset:offset + 64])
+    r = list(state)
+
+    for func, constant, order, shifts in rounds:
+      for i, k in enumerate(order):
+        # each step updates a, d, c, b in turn
+        t = -i % 4
+        value = (r[t] + func(r[(t + 1) % 4], r[(t + 2) % 4], r[(t + 3) % 4]) + words[k] + constant) & mask
+        r[t] = ((value << shifts[i % 4]) | (value >> (32 - shifts[i % 4]))) & mask
+
+    state = [(a + b) & mask for a, b in zip(state, r)]
+
+  return struct.pack('<4I', *state).hex()
+
+def openssl_md4_hexdigest(data):
+  return hashlib.new('md4', data).hexdigest()
+
+# newer OpenSSL builds only have md4 with the legacy provider loaded
+try:
+  hashlib.new('md4', b'')
+  nt_hexdigest = openssl_md4_hexdigest
+except ValueError:
+  nt_hexdigest = md4_hexdigest
+
+def hash_password(password, p_type):
+  # modify the password for the correct type
+  if(p_type == 'nt'):
+    return nt_hexdigest(password.encode('utf-16le')).upper()
+  if(p_type == 'md5'):
+    return hashlib.md5(password.encode()).hexdigest()
+
+  return password
+
+def hash_batch(batch):
+  return [hash_password(password, p_type) for password, p_type in batch]
+
+def hash_passwords(pairs, pool=None):
+  # hash (password, type) pairs, large sets are split over the process pool and come back in order
+  if(pool is None or len(pairs) <= HASH_BATCH):
+    return hash_batch(pairs)
+
+  result = []
+  for hashes in pool.map(hash_batch, [pairs[i:i + HASH_BATCH] for i in range(0, len(pairs), HASH_BATCH)]):
+    result.extend(hashes)
+
+  return result
+
+def column_types(chunk, column, default, valid, label):
+  # the type for every row, -1 means there is no column
+  if(column == -1):
+    return pandas.Series(default, index=chunk.index)
+
+  types = chunk.iloc[:, column].str.lower()
+
+  invalid = ~types.isin(valid)
+  for a_type in types[invalid]:
+    print(f"{label} {a_type} doesn't exist, setting to {default}")
+
+  return types.where(~invalid, default)
+
+def load_cache(cache_file):
+  # entries from the last run by cache key, empty if there isn't a usable cache
+  try:
+    with gzip.open(cache_file, 'rt') as f:
+      saved = json.load(f)
+
+    # a different version may generate entries differently
+    if(saved['version'] == __version__):
+      return saved['entries']
+  except (OSError, ValueError, KeyError):
+    pass
+
+  return {}
+
+def save_cache(cache_file, entries):
+  # the cache holds the same passwords as the output, only the owner can read it
+  tmp_file = f'{cache_file}.{os.getpid()}'
+  with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as raw:
+    # closing the gzip stream doesn't close the file it was given
+    with gzip.open(raw, 'wt') as f:
+      json.dump({'version': __version__, 'entries': entries}, f, separators=(',', ':'))
+
+  os.replace(tmp_file, cache_file)
+
+def cache_keys(usernames, passwords, r_types, p_types, vlan):
+  # digest of everything that goes into an entry, rows with the same key generate the same entry
+  # missing values are NaN from pandas or None from the csv reader
+  return [hashlib.sha256('\x1f'.join(value if isinstance(value, str) else '' for value in fields).encode()).hexdigest()
+          for fields in zip(usernames, passwords, r_types, p_types, [str(vlan)] * len(usernames))]
+
+def read_entries(path):
+  # username -> entry text from an authorize file, like freeradius the first entry for a user wins
+  entries = {}
+  if(not os.path.exists(path)):
+    return entries
+
+  with open(path) as f:
+    user = None
+    for line in f:
+      if(line.strip() == '' or line.startswith('#')):
+        user = None
+      elif(line[:1].isspace()):
+        # reply lines belong to the entry above them
+        if(user is not None):
+          entries[user] += line
+      else:
+        user = line.split(None, 1)[0]
+        if(user in entries):
+          user = None
+        else:
+          entries[user] = line
+
+  return entries
+
+def diff_entries(old_file, new_file):
+  # print the users added, removed and changed between two authorize files, returns the number of changes
+  old = read_entries(old_file)
+  new = read_entries(new_file)
+
+  added = sorted(new.keys() - old.keys())
+  removed = sorted(old.keys() - new.keys())
+  changed = sorted(user for user in new.keys() & old.keys() if new[user] != old[user])
+
+  for label, users in (('Added', added), ('Removed', removed), ('Changed', changed)):
+    for user in users:
+      print(f"{label}: {user}")
+
+  print(f"{len(added)} added, {len(removed)} removed, {len(changed)} changed")
+  return len(added) + len(removed) + len(changed)
+
+def chunk_fields(chunk, args):
+  usernames = chunk.iloc[:, args.user_column]
+  passwords = chunk.iloc[:, args.pass_column]
+
+  # set types to generic and clear if they don't exist
+  r_types = column_types(chunk, args.type_column, 'generic', RECORD_TYPES, 'Record type')
+  p_types = column_types(chunk, args.auth_column, 'clear', PASSWORD_TYPES, 'Auth Type')
+
+  return usernames, passwords, r_types, p_types
+
+def prepare_entries(usernames, passwords, r_types, p_types, pool=None):
+  # returns the usernames and passwords as they are sent, which rows are phones and their Calling-Station-Id
+  phones = r_types == 'phone'
+
+  # phones are checked against the station they call from
+  calling_station = usernames[phones].str.upper()
+  calling_station = calling_station.str[0:2].str.cat([calling_station.str[i:i+2] for i in range(2,12,2)], sep='-')
+
+  # if username is a MAC format for sent format
+  macs = usernames.str.strip().str.match(MAC_PATTERN)
+  usernames = usernames.where(~macs, usernames.str.replace('-', '', regex=False).str.replace(':', '', regex=False).str.lower())
+
+  # generate a password if one isn't set, reverse the username to create a password
+  passwords = passwords.where(passwords.notnull(), usernames.str[::-1])
+
+  hashed = (p_types == 'nt') | (p_types == 'md5')
+  if(hashed.any()):
+    passwords[hashed] = hash_passwords(list(zip(passwords[hashed], p_types[hashed])), pool)
+
+  return usernames, passwords, phones, calling_station
+
+def render_entries(usernames, passwords, r_types, p_types, args, pool=None):
+  usernames, passwords, phones, calling_station = prepare_entries(usernames, passwords, r_types, p_types, pool)
+
+  # any custom type settings, phones get a Calling-Station-Id control pair
+  control_pairs = pandas.Series('', index=usernames.index)
+  if(phones.any()):
+    control_pairs[phones] = ', Calling-Station-Id == "' + calling_station + '"'
+
+  lines = usernames + '  ' + p_types.map(PASSWORD_MATRIX).fillna('') + ' := ' + passwords + control_pairs
+  no_auth = p_types == 'none'
+  lines[no_auth] = usernames[no_auth] + '  ' + control_pairs[no_auth]
+
+  # reply attributes
+  accept_reply = []
+  if(args.vlan):
+    # if a vlan is given, add it as part of the reply
+    accept_reply.append('Tunnel-Type = VLAN')
+    accept_reply.append('Tunnel-Medium-Type = IEEE-802')
+    accept_reply.append(f'Tunnel-Private-Group-Id = "{args.vlan}"')
+
+  replies = pandas.Series(f'\t{", ".join(accept_reply)}\n' if len(accept_reply) > 0 else '', index=usernames.index)
+  if(phones.any()):
+    replies[phones] = f'\t{", ".join(accept_reply + [PHONE_REPLY])}\n'
+
+  return lines + '\n' + replies
+
+def generate_chunk(chunk, args, pool=None, cache=None, new_cache=None):
+  usernames, passwords, r_types, p_types = chunk_fields(chunk, args)
+
+  if(cache is None):
+    return ''.join(render_entries(usernames, passwords, r_types, p_types, args, pool).tolist())
+
+  # reuse entries from the last run, only new or changed rows are generated and hashed
+  keys = cache_keys(usernames, passwords, r_types, p_types, args.vlan)
+  entries = pandas.Series([cache.get(key) for key in keys], index=chunk.index, dtype=object)
+
+  misses = entries.isnull()
+  if(misses.any()):
+    entries[misses] = render_entries(usernames[misses], passwords[misses], r_types[misses], p_types[misses], args, pool)
+
+  new_cache.update(zip(keys, entries))
+  return ''.join(entries.tolist())
+
+def generate_pairs(chunk, args, pool=None):
+  # (username, check pairs, reply pairs) for each row, pairs are (attribute, op, value) like the radcheck and radreply tables
+  usernames, passwords, r_types, p_types = chunk_fields(chunk, args)
+  usernames, passwords, phones, calling_station = prepare_entries(usernames, passwords, r_types, p_types, pool)
+
+  return entry_pairs(usernames, passwords, p_types, phones, calling_station.reindex(usernames.index), args)
+
+def entry_pairs(usernames, passwords, p_types, phones, calling_station, args):
+  # check and reply pairs from the prepared values of each row
+  accept_reply = []
+  if(args.vlan):
+    accept_reply = [('Tunnel-Type', '=', 'VLAN'), ('Tunnel-Medium-Type', '=', 'IEEE-802'), ('Tunnel-Private-Group-Id', '=', str(args.vlan))]
+
+  result = []
+  for username, password, p_type, phone, station in zip(usernames, passwords, p_types, phones, calling_station):
+    check = []
+    if(p_type != 'none'):
+      check.append((PASSWORD_MATRIX[p_type], ':=', password))
+
+    reply = list(accept_reply)
+    if(phone):
+      check.append(('Calling-Station-Id', '==', station))
+      reply.append(('Cisco-AVPair', '=', PHONE_AVPAIR))
+
+    result.append((username, check, reply))
 
-def generate_auth_line(username, password, r_type, p_type):
-  control_pairs = []
+  return result
 
-  # set type to generic if it doesn't exist
-  if(r_type not in RECORD_TYPES):
-    print(f"Record type {r_type} doesn't exist, setting to generic")
-    r_type = 'generic'
+def read_rows(input_file, chunk_size):
+  # rows from the csv module in chunks, the header is skipped and missing values are None
+  with open(input_file, newline='', encoding='utf-8') as f:
+    reader = csv.reader(f)
+    next(reader, None)
 
-  if(p_type not in PASSWORD_TYPES):
-    print(f"Auth Type {p_type} doesn't exist, setting to clear")
-    p_type = 'clear'
+    rows = []
+    for row in reader:
+      # pandas skips blank lines
+      if(len(row) == 0):
+        continue
 
-  # any custom type settings
-  if(r_type == 'phone'):
-    # set the control pair
-    calling_station = username.upper()
-    calling_station = "-".join(calling_station[i:i+2] for i in range(0,12,2))
-    control_pairs.append(f"Calling-Station-Id == \"{calling_station}\"")
+      rows.append([None if value in NA_VALUES else value for value in row])
+      if(len(rows) == chunk_size):
+        yield rows
+        rows = []
+
+    if(len(rows) > 0):
+      yield rows
+
+def row_value(row, column):
+  # short rows are missing the rest of their values
+  return row[column] if column < len(row) else None
+
+def row_types(rows, column, default, valid, label):
+  # the same as column_types for rows from the csv reader
+  if(column == -1):
+    return [default] * len(rows)
+
+  result = []
+  for row in rows:
+    a_type = row_value(row, column)
+    a_type = a_type.lower() if a_type is not None else None
+
+    if(a_type not in valid):
+      print(f"{label} {a_type} doesn't exist, setting to {default}")
+      a_type = default
+
+    result.append(a_type)
+
+  return result
+
+def row_fields(rows, args):
+  usernames = [row_value(row, args.user_column) for row in rows]
+  passwords = [row_value(row, args.pass_column) for row in rows]
+
+  # set types to generic and clear if they don't exist
+  r_types = row_types(rows, args.type_column, 'generic', RECORD_TYPES, 'Record type')
+  p_types = row_types(rows, args.auth_column, 'clear', PASSWORD_TYPES, 'Auth Type')
+
+  return usernames, passwords, r_types, p_types
+
+def prepare_rows(usernames, passwords, r_types, p_types, pool=None):
+  # the same as prepare_entries for lists of values, calling station is None for anything but phones
+  phones = [r_type == 'phone' for r_type in r_types]
+  calling_station = ['-'.join(username.upper()[i:i+2] for i in range(0,12,2)) if phone else None for username, phone in zip(usernames, phones)]
 
   # if username is a MAC format for sent format
-  if(is_mac(username)):
-    username = username.replace('-', '').replace(':','').lower()
-
-  # generate a password if one isn't set
-  if(pandas.isnull(password)):
-    # reverse the username to create a password
-    password = username[::-1]
-
-  if(p_type != 'clear'):
-    # modify the password for the correct type
-    if(p_type == 'nt'):
-      hash = hashlib.new('md4', password.encode('utf-16le')).hexdigest()
-      password = hash.upper()
-    if(p_type == 'md5'):
-      hash = hashlib.md5(password.encode())
-      password = hash.hexdigest()
-
-  if(p_type != 'none'):
-    return f"{username}  {PASSWORD_MATRIX[p_type]} := {password}{generate_control_pairs(control_pairs)}"
+  usernames = [username.replace('-', '').replace(':', '').lower() if re.match(MAC_PATTERN, username.strip()) else username for username in usernames]
+
+  # generate a password if one isn't set, reverse the username to create a password
+  passwords = [username[::-1] if password is None else password for username, password in zip(usernames, passwords)]
+
+  hashed = [i for i, p_type in enumerate(p_types) if p_type == 'nt' or p_type == 'md5']
+  if(len(hashed) > 0):
+    for i, password in zip(hashed, hash_passwords([(passwords[i], p_types[i]) for i in hashed], pool)):
+      passwords[i] = password
+
+  return usernames, passwords, phones, calling_station
+
+def render_rows(usernames, passwords, r_types, p_types, args, pool=None):
+  # the same as render_entries for lists of values
+  usernames, passwords, phones, calling_station = prepare_rows(usernames, passwords, r_types, p_types, pool)
+
+  accept_reply = []
+  if(args.vlan):
+    accept_reply = ['Tunnel-Type = VLAN', 'Tunnel-Medium-Type = IEEE-802', f'Tunnel-Private-Group-Id = "{args.vlan}"']
+
+  reply = f'\t{", ".join(accept_reply)}\n' if len(accept_reply) > 0 else ''
+  phone_reply = f'\t{", ".join(accept_reply + [PHONE_REPLY])}\n'
+
+  entries = []
+  for username, password, p_type, phone, station in zip(usernames, passwords, p_types, phones, calling_station):
+    control_pairs = f', Calling-Station-Id == "{station}"' if phone else ''
+
+    if(p_type == 'none'):
+      line = f'{username}  {control_pairs}'
+    else:
+      line = f'{username}  {PASSWORD_MATRIX[p_type]} := {password}{control_pairs}'
+
+    entries.append(line + '\n' + (phone_reply if phone else reply))
+
+  return entries
+
+def generate_rows(rows, args, pool=None, cache=None, new_cache=None):
+  # the same as generate_chunk for rows from the csv reader
+  usernames, passwords, r_types, p_types = row_fields(rows, args)
+
+  if(cache is None):
+    return ''.join(render_rows(usernames, passwords, r_types, p_types, args, pool))
+
+  # reuse entries from the last run, only new or changed rows are generated and hashed
+  keys = cache_keys(usernames, passwords, r_types, p_types, args.vlan)
+  entries = [cache.get(key) for key in keys]
+
+  misses = [i for i, entry in enumerate(entries) if entry is None]
+  if(len(misses) > 0):
+    rendered = render_rows([usernames[i] for i in misses], [passwords[i] for i in misses], [r_types[i] for i in misses], [p_types[i] for i in misses], args, pool)
+    for i, entry in zip(misses, rendered):
+      entries[i] = entry
+
+  new_cache.update(zip(keys, entries))
+  return ''.join(entries)
+
+def generate_row_pairs(rows, args, pool=None):
+  # the same as generate_pairs for rows from the csv reader
+  usernames, passwords, r_types, p_types = row_fields(rows, args)
+  usernames, passwords, phones, calling_station = prepare_rows(usernames, passwords, r_types, p_types, pool)
+
+  return entry_pairs(usernames, passwords, p_types, phones, calling_station, args)
+
+def import_pandas():
+  global pandas
+  import pandas
+
+def read_chunks(args):
+  # chunks of the spreadsheet, DataFrames from pandas or lists of rows from the csv module
+  if(args.reader == 'pandas'):
+    # every column as text so each chunk is treated the same
+    return pandas.read_csv(args.input_file, dtype=str, chunksize=args.chunk_size)
+
+  return read_rows(args.input_file, args.chunk_size)
+
+def select_users(db, query, usernames):
+  # run a query with WHERE username IN ({}) for any number of usernames, yields the rows
+  for i in range(0, len(usernames), SQL_BATCH):
+    batch = usernames[i:i + SQL_BATCH]
+    yield from db.execute(query.format(', '.join('?' * len(batch))), batch)
+
+def load_pairs(db, table, usernames):
+  # username -> list of (attribute, op, value) currently in a table, only for the usernames given
+  users = {}
+  for username, attribute, op, value in select_users(db, f'SELECT username, attribute, op, value FROM {table} WHERE username IN ({{}}) ORDER BY id', usernames):
+    users.setdefault(username, []).append((attribute, op, value))
+
+  return users
+
+def pairs_digest(check, reply):
+  # the same check and reply pairs always give the same digest
+  return hashlib.sha256(repr((check, reply)).encode()).hexdigest()
+
+def write_database(args, pool=None):
+  # upsert the rows into a rlm_sql database, users whose pairs didn't change aren't touched
+  # rows changed by hand aren't seen while the user's digest still matches
+  # returns the number of changed users
+  db = sqlite3.connect(args.database)
+  db.executescript(SQL_SCHEMA)
+
+  seen = set()
+  added = []
+  changed = []
+  total = 0
+  try:
+    # all changes go in one transaction, freeradius sees the old or new set of users and never a mix
+    with db:
+      for chunk in read_chunks(args):
+        total = total + len(chunk)
+        chunk_pairs = generate_pairs(chunk, args, pool) if args.reader == 'pandas' else generate_row_pairs(chunk, args, pool)
+
+        # like the users file the first entry for a user wins
+        entries = []
+        for username, check, reply in chunk_pairs:
+          if(username not in seen):
+            seen.add(username)
+            entries.append((username, check, reply))
+
+        # only the digests of the users in this chunk are looked up, the pairs are never loaded whole
+        usernames = [username for username, check, reply in entries]
+        digests = dict(select_users(db, 'SELECT username, digest FROM raddigest WHERE username IN ({})', usernames))
+
+        # users without a digest (added by hand or by an older version) are compared pair by pair
+        unknown = [username for username in usernames if username not in digests]
+        old_check = load_pairs(db, 'radcheck', unknown)
+        old_reply = load_pairs(db, 'radreply', unknown)
+
+        updates = []
+        stale = []
+        new_digests = []
+        for username, check, reply in entries:
+          digest = pairs_digest(check, reply)
+
+          if(username in digests):
+            if(digests[username] == digest):
+              continue
+            changed.append(username)
+            stale.append((username,))
+          elif(username in old_check or username in old_reply):
+            if(old_check.get(username, []) != check or old_reply.get(username, []) != reply):
+              changed.append(username)
+              stale.append((username,))
+            else:
+              # unchanged, only the digest is new
+              new_digests.append((username, digest))
+              continue
+          else:
+            added.append(username)
+
+          updates.append((username, check, reply))
+          new_digests.append((username, digest))
+
+        # one statement per table for the whole chunk
+        db.executemany('DELETE FROM radcheck WHERE username = ?', stale)
+        db.executemany('DELETE FROM radreply WHERE username = ?', stale)
+        db.executemany('INSERT INTO radcheck (username, attribute, op, value) VALUES (?, ?, ?, ?)',
+                       [(username,) + pair for username, check, reply in updates for pair in check])
+        db.executemany('INSERT INTO radreply (username, attribute, op, value) VALUES (?, ?, ?, ?)',
+                       [(username,) + pair for username, check, reply in updates for pair in reply])
+        db.executemany('INSERT OR REPLACE INTO raddigest (username, digest) VALUES (?, ?)', new_digests)
+
+      # anyone not in the spreadsheet is removed unless appending
+      removed = []
+      if(not args.append):
+        existing = db.execute('SELECT username FROM radcheck UNION SELECT username FROM radreply UNION SELECT username FROM raddigest')
+        removed = sorted(username for (username,) in existing if username not in seen)
+        for table in ('radcheck', 'radreply', 'raddigest'):
+          db.executemany(f'DELETE FROM {table} WHERE username = ?', [(username,) for username in removed])
+
+      print(f"Processed {total} records")
+      if(args.dry_run):
+        for label, users in (('Added', sorted(added)), ('Removed', removed), ('Changed', sorted(changed))):
+          for user in users:
+            print(f"{label}: {user}")
+
+        db.rollback()
+
+      print(f"{len(added)} added, {len(removed)} removed, {len(changed)} changed")
+  finally:
+    db.close()
+
+  return len(added) + len(removed) + len(changed)
+
+def write_users_file(args, pool=None):
+  # the output is written to a temp file and only replaces the current one if it changed
+  # returns the number of changed users on a dry run
+  tmp_file = f'{args.output_file}.{os.getpid()}'
+  if(args.append and os.path.exists(args.output_file)):
+    shutil.copyfile(args.output_file, tmp_file)
+
+  # file mode is either write or append
+  file_mode = 'a' if args.append else 'w'
+
+  cache = None
+  new_cache = {}
+  if(args.cache):
+    cache = load_cache(args.cache)
+
+  # read the spreadsheet in chunks
+  total = 0
+  try:
+    with open(tmp_file, file_mode, buffering=1024 * 1024) as f:
+      for chunk in read_chunks(args):
+        if(args.reader == 'pandas'):
+          f.write(generate_chunk(chunk, args, pool, cache, new_cache))
+        else:
+          f.write(generate_rows(chunk, args, pool, cache, new_cache))
+        total = total + len(chunk)
+  except BaseException:
+    if(os.path.exists(tmp_file)):
+      os.remove(tmp_file)
+    raise
+
+  print(f"Processed {total} records")
+  if(cache is not None):
+    print(f"Reused {len(new_cache.keys() & cache.keys())} cached entries")
+
+  if(args.dry_run):
+    changes = diff_entries(args.output_file, tmp_file)
+    os.remove(tmp_file)
+    return changes
+
+  if(os.path.exists(args.output_file) and filecmp.cmp(tmp_file, args.output_file, shallow=False)):
+    # nothing changed, leave the file alone so freeradius doesn't need a reload
+    os.remove(tmp_file)
+    print(f"No changes, {args.output_file} not rewritten")
   else:
-    return f"{username}  {generate_control_pairs(control_pairs)}"
-
-#setup the cli parser
-parser = argparse.ArgumentParser(description='generate a freeradius authorization file from a spreadsheet')
-parser.add_argument('-i', '--input_file', required=True, help='Path to a CSV file to read')
-parser.add_argument('-o', '--output_file', required=False, type=str, default='authorize.txt',
-                   help='Path to the output file, default authorize.txt')
-parser.add_argument('-A', '--append', action='store_true',
-                   help='Append the output file instead of overwriting it, default is no')
-parser.add_argument('-u', '--user_column', required=False, type=int, default=1, help='Column number that contains the username')
-parser.add_argument('-p', '--pass_column', required=False, type=int, default=2, help='Column number that contains the password')
-parser.add_argument('-t', '--type_column', required=False, type=int, default=0,
-                   help='Column number that contains the device type column, options are phone, or generic. -1 assumes all types are generic (no designated column)')
-parser.add_argument('-a','--auth_column', required=False, type=int, default=-1,
-                   help="Column number that contains the auth type column, options are none, clear, md5 or nt. -1 defaults to clear text (no designated column)")
-parser.add_argument('-v','--vlan', required=False, type=int,
-                   help="If a VLAN should be returned as part of the auth response - default is no")
-args = parser.parse_args(sys.argv[1:])
-
-print(f"Generating FreeRadius users file from: {args.input_file}")
-print(f"Writing output to {args.output_file}")
-
-# open the document
-document = pandas.read_csv(args.input_file)
-print(f"Loaded document has {len(document.index)} records")
-
-# file mode is either write or append
-file_mode = 'a' if args.append else 'w'
-
-# write each line to the output file
-with open(args.output_file, file_mode) as f:
-  # iterate over each row
-  for index, row in document.iterrows():
-    record_type = 'generic' if args.type_column == -1 else row[args.type_column].lower()
-
-    password_type = 'clear' if args.auth_column == -1 else row[args.auth_column].lower()
-
-    f.write(generate_auth_line(row[args.user_column], row[args.pass_column], record_type, password_type))
-    f.write("\n")
-
-    accept_reply = []
-    if(args.vlan):
-        # if a vlan is given, add it as part of the reply
-        accept_reply.append('Tunnel-Type = VLAN')
-        accept_reply.append('Tunnel-Medium-Type = IEEE-802')
-        accept_reply.append(f'Tunnel-Private-Group-Id = "{args.vlan}"')
-
-    if(record_type == 'phone'):
-        accept_reply.append('Cisco-AVPair = "device-traffic-class = voice"')
-
-    if(len(accept_reply) > 0):
-        f.write(f'\t{", ".join(accept_reply)}')
-        f.write('\n')
+    if(os.path.exists(args.output_file)):
+      shutil.copymode(args.output_file, tmp_file)
+    os.replace(tmp_file, args.output_file)
+    print(f"Wrote {args.output_file}")
+
+  if(cache is not None):
+    save_cache(args.cache, new_cache)
+
+  return 0
+
+def main():
+  #setup the cli parser
+  parser = argparse.ArgumentParser(description='generate a freeradius authorization file from a spreadsheet')
+  parser.add_argument('-i', '--input_file', required=True, help='Path to a CSV file to read')
+  parser.add_argument('-o', '--output_file', required=False, type=str, default='authorize.txt',
+                     help='Path to the output file, default authorize.txt')
+  parser.add_argument('-A', '--append', action='store_true',
+                     help='Append the output file instead of overwriting it, default is no')
+  parser.add_argument('-u', '--user_column', required=False, type=int, default=1, help='Column number that contains the username')
+  parser.add_argument('-p', '--pass_column', required=False, type=int, default=2, help='Column number that contains the password')
+  parser.add_argument('-t', '--type_column', required=False, type=int, default=0,
+                     help='Column number that contains the device type column, options are phone, or generic. -1 assumes all types are generic (no designated column)')
+  parser.add_argument('-a','--auth_column', required=False, type=int, default=-1,
+                     help="Column number that contains the auth type column, options are none, clear, md5 or nt. -1 defaults to clear text (no designated column)")
+  parser.add_argument('-v','--vlan', required=False, type=int,
+                     help="If a VLAN should be returned as part of the auth response - default is no")
+  parser.add_argument('-c','--chunk_size', required=False, type=int, default=50000,
+                     help="Rows to read from the spreadsheet at a time, default 50000")
+  parser.add_argument('-d','--database', required=False, type=str,
+                     help="Write the users to the radcheck and radreply tables of this SQLite database for rlm_sql instead of an output file")
+  parser.add_argument('-C','--cache', required=False, type=str,
+                     help="Cache file of generated entries for the output file, only new or changed rows are hashed again - default is no cache")
+  parser.add_argument('-n','--dry_run', action='store_true',
+                     help="List the users that would be added, removed or changed without writing anything, exits 1 if there are changes")
+  parser.add_argument('-r','--reader', required=False, type=str, choices=['csv', 'pandas'], default='csv',
+                     help="How to read the spreadsheet, the csv module or pandas (needs pandas installed) - default csv")
+  parser.add_argument('-j','--jobs', required=False, type=int, default=os.cpu_count(),
+                     help="Processes to hash md5 and nt passwords with, default is the number of CPUs")
+  args = parser.parse_args(sys.argv[1:])
+  if(args.reader == 'pandas'):
+    import_pandas()
+
+  print(f"Generating FreeRadius users file from: {args.input_file}")
+  print(f"Writing output to {args.database if args.database else args.output_file}")
+
+  # hashing is spread over a process pool when there is more than one job
+  pool = None
+  if(args.jobs is not None and args.jobs > 1):
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs)
+
+  try:
+    if(args.database):
+      changes = write_database(args, pool)
+    else:
+      changes = write_users_file(args, pool)
+  finally:
+    if(pool is not None):
+      pool.shutdown()
+
+  if(args.dry_run):
+    sys.exit(1 if changes > 0 else 0)
 
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Compare the run time of generate_freeradius_file.py with the csv and pandas readers.
+Each run is a new process so the time includes interpreter startup and imports, which is what a cron job pays
+Exits 1 if the readers generate different output"""
+import argparse, filecmp, os, random, shutil, subprocess, sys, tempfile, time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generate_freeradius_file.py')
+
+def generate_csv(path, rows):
+  # a mix of phones and generic devices, some with MAC usernames and some without passwords
+  with open(path, 'w') as f:
+    f.write('type,user,pass,auth\n')
+    for i in range(0, rows):
+      if(i % 3 == 0):
+        user = ':'.join(f'{random.randrange(256):02x}' for j in range(0, 6))
+      else:
+        user = f'user{i}'
+
+      password = '' if i % 7 == 0 else f'secret{i}'
+      f.write(f"{'phone' if i % 4 == 0 else 'generic'},{user},{password},{random.choice(['clear', 'md5', 'nt', 'none'])}\n")
+
+def time_run(command, number):
+  times = []
+  for i in range(0, number):
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    times.append(time.perf_counter() - start)
+
+  return min(times), sum(times) / len(times)
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the generate_freeradius_file.py readers')
+  parser.add_argument('-r', '--rows', required=False, type=int, action='append',
+                      help='Rows in a generated spreadsheet, can be more than one - default 100 and 50000')
+  parser.add_argument('-n', '--number', required=False, type=int, default=5, help='Runs per reader, default 5')
+  args = parser.parse_args(sys.argv[1:])
+
+  sizes = args.rows if args.rows else [100, 50000]
+  tmp_dir = tempfile.mkdtemp(prefix='freeradius_')
+
+  try:
+    best, mean = time_run([sys.executable, '-c', 'import pandas'], args.number)
+    print(f"import pandas alone: best {best:.3f}s  mean {mean:.3f}s")
+
+    for rows in sizes:
+      input_file = os.path.join(tmp_dir, f'users{rows}.csv')
+      generate_csv(input_file, rows)
+      print(f"{rows} rows ({os.path.getsize(input_file)} bytes)")
+
+      outputs = []
+      for reader in ('csv', 'pandas'):
+        output_file = os.path.join(tmp_dir, f'authorize_{reader}.txt')
+        command = [sys.executable, SCRIPT, '-i', input_file, '-o', output_file, '-a', '3', '-v', '10', '-r', reader, '-j', '1']
+
+        best, mean = time_run(command, args.number)
+        print(f"  {reader:<8} best {best:.3f}s  mean {mean:.3f}s")
+        outputs.append(output_file)
+
+      # both readers have to generate the same file
+      if(not filecmp.cmp(outputs[0], outputs[1], shallow=False)):
+        print('  readers generated different output')
+        sys.exit(1)
+  finally:
+    shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+  main()
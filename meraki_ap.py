@@ -1,35 +1,195 @@
-"""Check various endpoints of a Meraki cloud enabled device, requires nagious /check_snmp command to be available"""
+"""Check various endpoints of a Meraki cloud enabled device, uses the hnmp library if installed otherwise requires nagious /check_snmp command to be available"""
 import argparse
 import sys
+import os
+import json
+import time
+import fcntl
 from subprocess import Popen,PIPE
 import re
 
+#uses hnmp library https://github.com/trehn/hnmp to query the device table in process
+#pip install hnmp
+try:
+    from hnmp import SNMP,SNMPError
+    from pysnmp.proto.rfc1905 import NoSuchInstance,NoSuchObject
+except ImportError:
+    SNMP = None
 
 #A python class for querying the Meraki Cloud Controller.
 #Setup SNMP under Organization->Settings in the Meraki cloud website
 #run python meraki_ap.py --help to get a list of arguments
 class MerakiSNMP:
     args = None
+    table_oid = '.1.3.6.1.4.1.29671.1.1.4.1'
+    commands = ['devStatus','devProductCode','devContactedAt','devClientCount']
     oid_dict =  {"devStatus":{'oid':'.1.3.6.1.4.1.29671.1.1.4.1.3','title':'Device Status'},
                  "devProductCode":{"oid":".1.3.6.1.4.1.29671.1.1.4.1.9","title":"Device Type"},
                  "devContactedAt":{"oid":".1.3.6.1.4.1.29671.1.1.4.1.4","title":"Last Contacted"},
-                 "devClientCount":{"oid":".1.3.6.1.4.1.29671.1.1.4.1.5","title":"Client Count"}}
+                 "devClientCount":{"oid":".1.3.6.1.4.1.29671.1.1.4.1.5","title":"Client Count"},
+                 "devName":{"oid":".1.3.6.1.4.1.29671.1.1.4.1.2","title":"Device Name"}}
     
     def __init__(self):
         mac = None
 
         #setup the parser
         parser = argparse.ArgumentParser()
-        parser.add_argument('-m','--mac',help='MAC Address of the AP',required=True)
-        parser.add_argument('-C','--command',required=True,choices=['devStatus','devProductCode','devContactedAt','devClientCount'],help='The command to run, valid values are devStatus,devProductCode,devClientCount,devContactedAt')
+        parser.add_argument('-m','--mac',help='MAC Address of the AP',required=False)
+        parser.add_argument('-C','--command',required=False,choices=self.commands,help='The command to run, valid values are devStatus,devProductCode,devClientCount,devContactedAt')
         parser.add_argument('-H','--host',required=True,help="The Meraki Controller address")
         parser.add_argument('-p','--port',required=True,help="The port for SNMP requests")
         parser.add_argument('-c','--community',required=True,help="The community string")
+        parser.add_argument('-M','--method',required=False,choices=['table','check_snmp'],default='table' if SNMP != None else 'check_snmp',help='Query the device table in process (table, needs hnmp) or run check_snmp for the OID, default is table if hnmp is installed')
+        parser.add_argument('-s','--snapshot',required=False,help='File to share the whole device table between checks, the table is only walked again once it is older than the ttl')
+        parser.add_argument('-T','--ttl',required=False,type=int,default=300,help='Seconds a snapshot is used for, default 300')
+        parser.add_argument('-S','--sweep',action='store_true',help='Check every AP in the device table, with --command only that check is done')
+        parser.add_argument('-o','--output',required=False,choices=['lines','passive'],default='lines',help='Sweep output, one line per AP or passive check results')
+        parser.add_argument('--command-file',required=False,default='/var/run/icinga2/cmd/icinga2.cmd',help='External command file for passive results')
         
         self.args = parser.parse_args()
 
+        if(not self.args.sweep and (self.args.mac == None or self.args.command == None)):
+            parser.error('--mac and --command are required unless --sweep is given')
+
+        if(self.args.method == 'table' and SNMP == None):
+            parser.error('the table method needs the hnmp library, pip install hnmp')
+
+        if(self.args.method == 'check_snmp' and (self.args.sweep or self.args.snapshot != None)):
+            parser.error('--sweep and --snapshot need the table method')
 
     def run(self):
+        if(self.args.method == 'check_snmp'):
+            return self._checkSNMP()
+
+        try:
+            if(self.args.snapshot != None):
+                table = self._getSnapshot()
+            elif(self.args.sweep):
+                table = self._walkTable(self.commands + ['devName'])
+            else:
+                #a single AP is one GET, the table is only walked when it is shared or swept
+                return self._getValue()
+        except SNMPError:
+            print "Error contacting " + self.args.host
+            return 3
+
+        if(self.args.sweep):
+            return self._sweep(table)
+
+        #rows are indexed by the MAC in decimal notation
+        row = table.get(self._macIndex(self.args.mac))
+        if(row == None or self.args.command not in row):
+            print self.oid_dict[self.args.command]['title'] + ": " + self.args.mac + " not found"
+            return 3
+
+        return self._processResult(row[self.args.command])
+
+    def _sweep(self,table):
+        commands = self.commands if self.args.command == None else [self.args.command]
+
+        results = []
+        for index in sorted(table.keys()):
+            row = table[index]
+            mac = ':'.join(['%02x' % int(aNum) for aNum in index.split('.')])
+
+            apResults = []
+            for aCommand in commands:
+                if(aCommand in row):
+                    exit_code,detail = self._result(aCommand,row[aCommand])
+                    apResults.append((aCommand,exit_code,self.oid_dict[aCommand]['title'] + ": " + detail))
+
+            #APs without a name are known by their MAC
+            results.append((row.get('devName') or mac,mac,apResults))
+
+        if(self.args.output == 'passive'):
+            now = int(time.time())
+            with open(self.args.command_file,'a') as f:
+                for name,mac,apResults in results:
+                    for aCommand,exit_code,output in apResults:
+                        f.write('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;Meraki %s;%d;%s\n' % (now,name,self.oid_dict[aCommand]['title'],exit_code,output))
+
+            print 'Submitted results for ' + str(len(results)) + ' APs'
+            return 0
+
+        worst = 0
+        for name,mac,apResults in results:
+            print name + ' (' + mac + '): ' + ', '.join([output for aCommand,exit_code,output in apResults])
+            worst = max([worst] + [exit_code for aCommand,exit_code,output in apResults])
+
+        return worst
+
+    def _getSnapshot(self):
+        #hold the lock while walking so other checks wait for this snapshot instead of walking too
+        lockFile = open(self.args.snapshot + '.lock','a')
+        try:
+            fcntl.flock(lockFile,fcntl.LOCK_EX)
+
+            try:
+                if(time.time() - os.path.getmtime(self.args.snapshot) < self.args.ttl):
+                    with open(self.args.snapshot,'r') as f:
+                        snapshot = json.load(f)
+
+                    if(snapshot['host'] == self.args.host and snapshot['port'] == self.args.port):
+                        return snapshot['rows']
+            except (IOError,OSError,ValueError,KeyError):
+                pass
+
+            #the snapshot has every column so it can answer any check
+            rows = self._walkTable(self.commands + ['devName'])
+
+            tmpFile = '%s.%d' % (self.args.snapshot,os.getpid())
+            fd = os.open(tmpFile,os.O_WRONLY | os.O_CREAT | os.O_TRUNC,0o600)
+            with os.fdopen(fd,'w') as f:
+                json.dump({'host':self.args.host,'port':self.args.port,'rows':rows},f)
+            os.rename(tmpFile,self.args.snapshot)
+
+            return rows
+        finally:
+            lockFile.close()
+
+    def _walkTable(self,commands):
+        #walk the columns of the device table with GETBULK, returns the rows by index with values in the form check_snmp gives
+        snmp = SNMP(self.args.host,port=int(self.args.port),community=self.args.community)
+
+        columns = {}
+        for aCommand in commands:
+            columns[int(self.oid_dict[aCommand]['oid'].split('.')[-1])] = aCommand
+
+        table = snmp.table(self.table_oid,columns=columns,fetch_all_columns=False,max_repetitions=50)
+
+        result = {}
+        for row in table.rows:
+            result[row['_row_id']] = dict([(aCommand,self._tableValue(aCommand,row[aCommand])) for aCommand in commands if aCommand in row])
+
+        return result
+
+    def _getValue(self):
+        snmp = SNMP(self.args.host,port=int(self.args.port),community=self.args.community)
+
+        value = snmp.get(self._createOID())
+
+        #hnmp leaves noSuchInstance and noSuchObject as pysnmp objects
+        if(isinstance(value,(NoSuchInstance,NoSuchObject))):
+            print self.oid_dict[self.args.command]['title'] + ": " + self.args.mac + " not found"
+            return 3
+
+        return self._processResult(self._tableValue(self.args.command,value))
+
+    def _tableValue(self,command,value):
+        #put the value in the same form check_snmp gives so it is processed the same way
+        if(command == 'devContactedAt'):
+            #octet strings are shown as space separated hex
+            if(not isinstance(value,bytes)):
+                value = value.encode('latin-1')
+
+            return ' '.join(['%02X' % b for b in bytearray(value)])
+
+        if(command == 'devName'):
+            return value
+
+        return str(value).strip()
+
+    def _checkSNMP(self):
 	result = 0
 
         #first create the oid to query
@@ -61,39 +221,48 @@ class MerakiSNMP:
 	return result
 
     def _processResult(self,output):
+        exit_code,detail = self._result(self.args.command,output)
+
+        if (self.args.command == 'devContactedAt'):
+            print detail
+        else:
+            print self.oid_dict[self.args.command]['title'] + ": " + detail
+
+        return exit_code
+
+    def _result(self,command,output):
+        #returns the exit code and the text for a value
         exit_code = 0
         
-        if(self.args.command == 'devStatus'):
+        if(command == 'devStatus'):
             if(int(output) != 1):
                 exit_code = 2
-                print self.oid_dict[self.args.command]['title'] + ": device is offline"
+                detail = "device is offline"
             else:
-                print self.oid_dict[self.args.command]['title'] + ": device is online"
-        elif(self.args.command == 'devProductCode'):
-            print self.oid_dict[self.args.command]['title'] + ": " + output
-        elif (self.args.command == 'devClientCount'):
+                detail = "device is online"
+        elif(command == 'devProductCode'):
+            detail = output
+        elif (command == 'devClientCount'):
             if(int(output) > 25):
                 #throw a warning here, this is kind of alot
                 exit_code = 1
-            print self.oid_dict[self.args.command]['title'] + ": " + output
-        elif (self.args.command == 'devContactedAt'):
+            detail = output
+        elif (command == 'devContactedAt'):
             splitArray = output.split(' ')
-            print str(int(splitArray[2],16)) + "-" + str(int(splitArray[3],16)) + "-" + str(int(splitArray[0] + splitArray[1],16)) + " " + str(int(splitArray[4],16) - int(splitArray[9],16)) + ":" + str(int(splitArray[5],16))
+            detail = str(int(splitArray[2],16)) + "-" + str(int(splitArray[3],16)) + "-" + str(int(splitArray[0] + splitArray[1],16)) + " " + str(int(splitArray[4],16) - int(splitArray[9],16)) + ":" + str(int(splitArray[5],16))
              
-        return exit_code
+        return (exit_code,detail)
                 
 
-    def _createOID(self):
-        result = ''
+    def _macIndex(self,mac):
+        #convert mac to decimal notation, this is the index of the device in the table
+        macArray = mac.split(':')
 
-        #convert mac to decimal notation
-        macArray = self.args.mac.split(':')
-
-        for aHex in macArray:
-            result = result + "." + str(int(aHex,16))
+        return '.'.join([str(int(aHex,16)) for aHex in macArray])
 
+    def _createOID(self):
         #add to oid
-        result = self.oid_dict[self.args.command]['oid'] + result
+        result = self.oid_dict[self.args.command]['oid'] + "." + self._macIndex(self.args.mac)
 
         return result
 